@@ -16,24 +16,49 @@
 #     along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 import os
+import re
 import time
 import json
 import copy
 import math
+import ssl
+import hashlib
+import random
 import socket
+import select
+import asyncio
 import urllib3
+import itertools
+import contextlib
+import http.client
+import http.server
 import threading
 import logging.handlers
-from queue import Queue
-from subprocess import call
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor, Future
 from os.path import expanduser
-from collections import namedtuple
+from urllib.parse import urlsplit
+from collections import namedtuple, deque, OrderedDict
 
 try:
     import argparse
 except ImportError:
     raise ImportError("Failed to import 'argparse'. Please install this module before continuing")
 
+try:
+    # Optional, converts colours for many lights in one call when it is installed
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    # Optional, parses the bridge's responses several times faster when it is installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
 # Server version
 server_version = '2.0'
 # Represents a CIE 1931 XY coordinate pair.
@@ -60,6 +85,9 @@ gamutc = (
     xypoint(0.153, 0.048),
 )
 
+# Gamut types as reported in a light's capabilities
+color_gamuts = {'A': gamuta, 'B': gamutb, 'C': gamutc}
+
 
 class ColorHelper:
     def __init__(self, gamut=gamutb):
@@ -154,16 +182,841 @@ class ColorHelper:
 
 
 class Converter:
+    # Converted colours are kept in a lookup table per gamut. The bridge reports xy to 4 decimal places, so
+    # keying on that resolution loses nothing and a house full of lights only ever needs a few hundred entries.
+    # Every converter for a gamut shares its table, so they share its lock too
+    tables = {}
+    locks = {}
+    setup_lock = threading.Lock()
+    table_size = 4096
+
     def __init__(self, gamut=gamutb):
+        self.gamut = gamut
         self.color = ColorHelper(gamut)
+        with self.setup_lock:
+            self.table = self.tables.setdefault(gamut, OrderedDict())
+            self.lock = self.locks.setdefault(gamut, threading.Lock())
 
     def rgb_to_xy(self, red, green, blue):
         point = self.color.get_xy_point_from_rgb(red, green, blue)
         return point.x, point.y
 
     def xy_to_rgb(self, x, y, bri=1):
-        r, g, b = self.color.get_rgb_from_xy_and_brightness(x, y, bri)
-        return r, g, b
+        return self.xy_to_rgb_many([(x, y)], bri)[0]
+
+    def xy_to_rgb_many(self, points, bri=1):
+        keys = [(round(x, 4), round(y, 4), bri) for x, y in points]
+        with self.lock:
+            missing = list(OrderedDict.fromkeys(key for key in keys if key not in self.table))
+        if missing:
+            if numpy is not None:
+                converted = self.numpy_xy_to_rgb([key[:2] for key in missing], bri)
+            else:
+                converted = [self.color.get_rgb_from_xy_and_brightness(key[0], key[1], bri) for key in missing]
+            with self.lock:
+                for key, rgb in zip(missing, converted):
+                    self.table[key] = rgb
+                while len(self.table) > self.table_size:
+                    self.table.popitem(last=False)
+        with self.lock:
+            return [self.table[key] if key in self.table else
+                    self.color.get_rgb_from_xy_and_brightness(key[0], key[1], bri) for key in keys]
+
+    def rgb_to_xy_many(self, colours):
+        if numpy is None:
+            return [self.rgb_to_xy(red, green, blue) for red, green, blue in colours]
+        rgb = numpy.asarray(colours, dtype=float).reshape(-1, 3)
+        linear = numpy.where(rgb > 0.04045, numpy.power((numpy.abs(rgb) + 0.055) / (1.0 + 0.055), 2.4),
+                             rgb / 12.92)
+        xyz = linear.dot(numpy.array([[0.664511, 0.283881, 0.000088],
+                                      [0.154324, 0.668433, 0.072310],
+                                      [0.162028, 0.047685, 0.986039]]))
+        total = xyz.sum(axis=1)
+        points = numpy.stack([xyz[:, 0] / total, xyz[:, 1] / total], axis=1)
+        return [tuple(point) for point in self.numpy_reach(points).tolist()]
+
+    def numpy_reach(self, points):
+        # Vector form of check_point_in_lamps_reach and get_closest_point_to_point
+        red, lime, blue = (numpy.array(corner, dtype=float) for corner in self.gamut)
+
+        def cross(one, two):
+            return one[..., 0] * two[..., 1] - one[..., 1] * two[..., 0]
+
+        v1 = lime - red
+        v2 = blue - red
+        q = points - red
+        s = cross(q, v2) / cross(v1, v2)
+        t = cross(v1, q) / cross(v1, v2)
+        in_reach = (s >= 0.0) & (t >= 0.0) & (s + t <= 1.0)
+        if in_reach.all():
+            return points
+        closest = []
+        for a, b in ((red, lime), (blue, red), (lime, blue)):
+            ab = b - a
+            along = numpy.clip((points - a).dot(ab) / ab.dot(ab), 0.0, 1.0)
+            closest.append(a + along[:, None] * ab)
+        closest = numpy.stack(closest)
+        nearest = numpy.sqrt(((closest - points) ** 2).sum(axis=2)).argmin(axis=0)
+        return numpy.where(in_reach[:, None], points, closest[nearest, numpy.arange(len(points))])
+
+    def numpy_xy_to_rgb(self, points, bri=1):
+        points = self.numpy_reach(numpy.asarray(points, dtype=float).reshape(-1, 2))
+        y = float(bri)
+        x = (y / points[:, 1]) * points[:, 0]
+        z = (y / points[:, 1]) * (1 - points[:, 0] - points[:, 1])
+        rgb = numpy.stack([x * 1.656492 - y * 0.354851 - z * 0.255038,
+                           -x * 0.707196 + y * 1.655397 + z * 0.036152,
+                           x * 0.051713 - y * 0.121364 + z * 1.011530], axis=1)
+        rgb = numpy.where(rgb <= 0.0031308, 12.92 * rgb,
+                          (1.0 + 0.055) * numpy.power(numpy.abs(rgb), 1.0 / 2.4) - 0.055)
+        rgb = numpy.maximum(rgb, 0)
+        rgb = rgb / numpy.maximum(rgb.max(axis=1), 1)[:, None]
+        return [tuple(colour) for colour in (rgb * 255).astype(int).tolist()]
+
+
+class DiffEngine:
+    # Keeps a fingerprint of every resource, plus one per field, instead of a deep copy of it.
+    # Unchanged resources cost a single canonical json.dumps, changed ones report only the changed fields
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+
+    @staticmethod
+    def encode(value):
+        return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+    def fingerprint_fields(self, data):
+        fields = {}
+        for key, value in data.items():
+            if isinstance(value, dict) and value:
+                for sub_key, sub_value in value.items():
+                    fields[(key, sub_key)] = hash(self.encode(sub_value))
+            else:
+                fields[(key,)] = hash(self.encode(value))
+        return fields
+
+    def diff(self, device, device_id, data):
+        # Returns None when nothing changed, otherwise the changed fields ({'state': {'bri': 120}}).
+        # A resource we have not seen before is returned whole
+        with metrics.timer('diff'):
+            return self.compare(device, device_id, data)
+
+    def compare(self, device, device_id, data):
+        fingerprint = hash(self.encode(data))
+        with self.lock:
+            snapshot = self.snapshots.get((device, device_id))
+            if snapshot is not None and snapshot[0] == fingerprint:
+                return None
+            fields = self.fingerprint_fields(data)
+            self.snapshots[(device, device_id)] = (fingerprint, fields)
+        if snapshot is None:
+            return data
+        changes = {}
+        for field in fields:
+            if snapshot[1].get(field) == fields[field]:
+                continue
+            if len(field) == 1:
+                changes[field[0]] = data[field[0]]
+            else:
+                changes.setdefault(field[0], {})[field[1]] = data[field[0]][field[1]]
+        return changes
+
+    def forget(self, device, device_id):
+        with self.lock:
+            self.snapshots.pop((device, device_id), None)
+
+
+class ProtocolMessage:
+    # A resource update for Savant. Clients using the delta protocol get only the fields that changed
+    def __init__(self, message_type, device_id, info, delta=None):
+        self.message_type = message_type
+        self.device_id = device_id
+        self.info = info
+        self.delta = delta
+        self.lines = {}
+
+    def line(self, protocol='full'):
+        if protocol == 'delta' and self.delta is not None:
+            if not self.delta:
+                # Only fields we never send to Savant changed
+                return None
+            payload = self.delta
+        else:
+            protocol = 'full'
+            payload = self.info
+        if protocol not in self.lines:
+            self.lines[protocol] = '#' + json.dumps(
+                {self.message_type: {"id": self.device_id, "info": payload}})
+        return self.lines[protocol]
+
+    def merge(self, newer):
+        # The newer resource wins. Delta clients still need every field that changed in either update,
+        # read back from the newer resource so the values are current
+        delta = None
+        if self.delta is not None and newer.delta is not None:
+            delta = {}
+            keys = set(self.delta) | set(newer.delta)
+            for key in newer.info:
+                if key not in keys:
+                    continue
+                if isinstance(newer.info[key], dict):
+                    fields = set(self.delta.get(key, {})) | set(newer.delta.get(key, {}))
+                    delta[key] = dict((field, newer.info[key][field]) for field in newer.info[key] if field in fields)
+                else:
+                    delta[key] = newer.info[key]
+        return ProtocolMessage(newer.message_type, newer.device_id, newer.info, delta)
+
+    def __str__(self):
+        return self.line()
+
+
+class StateSnapshot:
+    # Ready-encoded lines for everything a new Savant connection is sent, kept up to date as resources change.
+    # The joined buffer is only rebuilt when the version has moved on, so a burst of reconnects shares one
+    sections = ('lights', 'groups', 'sensors', 'scenes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = dict((section, OrderedDict()) for section in self.sections)
+        self.version = 0
+        self.built_version = -1
+        self.built = b''
+
+    def set(self, section, device_id, lines):
+        data = b''.join([(line + '\r\n').encode() for line in lines])
+        with self.lock:
+            if self.entries[section].get(device_id) == data:
+                return
+            self.entries[section][device_id] = data
+            self.version += 1
+
+    def discard(self, section, device_id):
+        with self.lock:
+            if self.entries[section].pop(device_id, None) is not None:
+                self.version += 1
+
+    def ids(self, section):
+        with self.lock:
+            return list(self.entries[section])
+
+    def buffer(self):
+        with self.lock:
+            if self.built_version != self.version:
+                self.built = b''.join([b''.join(self.entries[section].values()) for section in self.sections])
+                self.built_version = self.version
+            return self.built
+
+    def lines(self):
+        return [line for line in self.buffer().decode().split('\r\n') if line]
+
+
+class Metrics:
+    # Counters, gauges and latency histograms for the whole CoProcessor, read with the telnet 'stats' command
+    # or from the optional HTTP /metrics endpoint. Histograms only keep a count per bucket, so they cost the
+    # same however long the CoProcessor runs
+    buckets = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            current = self.gauges.setdefault(name, {'value': 0, 'max': 0})
+            current['value'] = value
+            current['max'] = max(current['max'], value)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.buckets) + 1)}
+                self.histograms[name] = histogram
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['max'] = max(histogram['max'], seconds)
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            histogram['buckets'][index] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def quantile(self, histogram, fraction):
+        # The upper bound of the bucket the quantile falls in, or the slowest seen past the last bucket
+        wanted = histogram['count'] * fraction
+        seen = 0
+        for index, bound in enumerate(self.buckets):
+            seen += histogram['buckets'][index]
+            if seen >= wanted:
+                return min(bound, histogram['max'])
+        return histogram['max']
+
+    def report(self):
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = {
+                    'count': histogram['count'],
+                    'avg': round(histogram['sum'] / histogram['count'], 6),
+                    'p50': round(self.quantile(histogram, 0.5), 6),
+                    'p95': round(self.quantile(histogram, 0.95), 6),
+                    'p99': round(self.quantile(histogram, 0.99), 6),
+                    'max': round(histogram['max'], 6)
+                }
+            return {'uptime': round(time.time() - self.started), 'counters': dict(self.counters),
+                    'gauges': copy.deepcopy(self.gauges), 'histograms': histograms}
+
+
+class Supervisor:
+    # Keeps the long running parts of a server or bridge going. A part that returns or dies with an error is
+    # started again on its own, after a delay that doubles each time it fails in quick succession, while
+    # everything else, the Savant connections and the store included, carries on untouched
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.components = OrderedDict()
+        self.stopping = threading.Event()
+
+    def add(self, name, target, generational=False):
+        # A generational target is given its generation, so it can stop once replace() has started another
+        with self.lock:
+            self.components[name] = {'target': target, 'generational': generational, 'generation': 0,
+                                     'failures': 0, 'restarts': 0, 'started': time.time(), 'thread': None}
+        self.launch(name)
+
+    def launch(self, name):
+        with self.lock:
+            component = self.components[name]
+            component['generation'] += 1
+            component['started'] = time.time()
+            worker = threading.Thread(target=self.guard, name=name, args=(name, component['generation']))
+            worker.setDaemon(True)
+            component['thread'] = worker
+        worker.start()
+
+    def replace(self, name, reason):
+        # For a part that is still running but has stopped working. Threads can't be killed, so a fresh one is
+        # started and the old one is left to finish on its own, without being restarted. Generational targets
+        # check current() so the old one stops as soon as it gets going again
+        logger.warning("#W0816 Replacing %s %s: %s" % (self.name, name, reason))
+        with self.lock:
+            self.components[name]['restarts'] += 1
+        metrics.count('restarts')
+        self.launch(name)
+
+    def current(self, name, generation):
+        with self.lock:
+            return self.components[name]['generation'] == generation
+
+    def guard(self, name, generation):
+        component = self.components[name]
+        while not self.stopping.is_set() and self.current(name, generation):
+            started = time.time()
+            try:
+                if component['generational']:
+                    component['target'](generation)
+                else:
+                    component['target']()
+                if self.stopping.is_set() or not self.current(name, generation):
+                    break
+                logger.error("#E6190 %s %s stopped unexpectedly" % (self.name, name))
+            except Exception as err_AP:
+                if self.stopping.is_set():
+                    break
+                logger.error("#E3841 %s %s caught an error: %s" % (self.name, name, err_AP), exc_info=True)
+            if time.time() - started > supervisor_stable:
+                # It had been running happily, so this is a fresh failure rather than one of a run
+                component['failures'] = 0
+            delay = min(supervisor_backoff_max, supervisor_backoff * 2 ** component['failures'])
+            component['failures'] += 1
+            component['restarts'] += 1
+            metrics.count('restarts')
+            logger.warning("#W7953 Restarting %s %s in %.1f seconds" % (self.name, name, delay))
+            if self.stopping.wait(delay):
+                break
+            component['started'] = time.time()
+
+    def wait(self):
+        self.stopping.wait()
+
+    def stop(self):
+        self.stopping.set()
+
+    def metrics(self):
+        with self.lock:
+            return dict(('%s %s' % (self.name, name), {
+                'alive': component['thread'] is not None and component['thread'].is_alive(),
+                'restarts': component['restarts'],
+                'uptime': round(time.time() - component['started'])
+            }) for name, component in self.components.items())
+
+
+class MessageCoalescer(threading.Thread):
+    # Sits between HTTPBridge and the message queue. The first update for a resource goes straight through, but
+    # further updates for it within the window are held back and collapsed, so only the latest is sent when the
+    # window closes. Anything that is not a resource update passes straight through
+    def __init__(self, message_queue, window):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.message_queue = message_queue
+        self.window = window
+        self.running = True
+        self.pending = OrderedDict()
+        self.last_sent = {}
+        self.ready = threading.Condition()
+
+    def put(self, message):
+        if not isinstance(message, ProtocolMessage):
+            self.message_queue.put(message)
+            return
+        key = (message.message_type, message.device_id)
+        with self.ready:
+            if key in self.pending:
+                self.pending[key] = self.pending[key].merge(message)
+                return
+            if time.time() - self.last_sent.get(key, 0) < self.window:
+                self.pending[key] = message
+                self.ready.notify()
+                return
+            self.last_sent[key] = time.time()
+        self.message_queue.put(message)
+
+    def run(self):
+        logger.debug("#D2147 Message coalescer started with a %s second window" % self.window)
+        while self.running:
+            with self.ready:
+                if not self.pending:
+                    self.ready.wait(1)
+                    continue
+                now = time.time()
+                due = [key for key in self.pending if now - self.last_sent.get(key, 0) >= self.window]
+                if not due:
+                    self.ready.wait(min(self.last_sent.get(key, 0) + self.window for key in self.pending) - now)
+                    continue
+                messages = [self.pending.pop(key) for key in due]
+                for key in due:
+                    self.last_sent[key] = now
+            for message in messages:
+                self.message_queue.put(message)
+        logger.debug("#D0575 Message coalescer finished")
+
+    def stop(self):
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+
+
+class CommandFramer:
+    # Savant sends each command with no terminator, so several can arrive in one read and one can be split
+    # across two. Commands are framed by their shape instead: a bare word such as 'lights' or 'restart', or a
+    # path, a JSON body and an optional colour (lights/1/state%{"on": true}%r). CR and LF still end a command,
+    # for telnet users. Anything left unfinished is held until the next read, or given up as it is once the
+    # client has gone quiet for savant_frame_timeout. A command that looks finished but could still go on, such
+    # as 'lights' before '/1/state' arrives, only waits savant_frame_settle
+    heads = (b'lights', b'groups', b'sensors', b'scenes', b'/lights', b'/groups', b'close', b'exit', b'quit',
+             b'restart', b'pace', b'queue', b'stats', b'delta', b'full')
+    bare = re.compile(rb'((lights|groups|sensors|scenes)(/\d+)?|close|exit|quit|restart|queue|stats|delta|full|'
+                      rb'pace \d+)$')
+    extendable = re.compile(rb'((lights|groups|sensors|scenes)(/\d+)?|pace \d+)$')
+    terminators = b'\r\n'
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.settling = False
+
+    def pending(self):
+        return len(self.buffer) > 0
+
+    def wait(self):
+        # Seconds to wait for more of the command being held, or None if nothing is
+        if not self.buffer:
+            return None
+        return savant_frame_settle if self.settling else savant_frame_timeout
+
+    def feed(self, data):
+        # Every complete command now in the buffer, in the order they were sent
+        self.buffer += data
+        self.settling = False
+        commands = []
+        start = 0
+        while start < len(self.buffer):
+            end, skip = self.frame(start)
+            if end is None:
+                break
+            commands.append(bytes(self.buffer[start:end]).decode('utf-8', 'replace'))
+            start = end + skip
+        del self.buffer[:start]
+        return commands
+
+    def flush(self):
+        # Whatever is left, as the command it was meant to be
+        command = bytes(self.buffer).decode('utf-8', 'replace')
+        del self.buffer[:]
+        return [command]
+
+    def starts_command(self, position):
+        return self.buffer.startswith(self.heads, position)
+
+    def frame(self, start):
+        # (end, terminator length) for the command starting here, or (None, 0) if it isn't all here yet
+        buffer = self.buffer
+        if buffer[start] in self.terminators:
+            # A blank line, as an empty command
+            return start, self.terminator_length(start)
+        position = start
+        while position < len(buffer) and buffer[position] not in b'%{\r\n':
+            if position > start and self.starts_command(position) and self.bare.match(buffer, start, position):
+                # Bare commands back to back, such as 'lightsgroups'
+                return position, 0
+            position += 1
+        if position == len(buffer):
+            # A bare command is complete, a path such as lights/1/state still needs its body
+            if not self.bare.match(buffer, start, position):
+                return None, 0
+            if self.extendable.match(buffer, start, position):
+                # 'lights' could be the start of lights/1/state, and 'pace 1' of 'pace 100'
+                self.settling = True
+                return None, 0
+            return position, 0
+        if buffer[position] in self.terminators:
+            return position, self.terminator_length(position)
+        # The profile's alert commands put the body straight after the path, without a %
+        body_end = self.body_end(position + 1 if buffer[position] == ord('%') else position)
+        if body_end is None:
+            return None, 0
+        if body_end == len(buffer) or buffer[body_end] != ord('%'):
+            return body_end, self.terminator_length(body_end)
+        # The colour, if any: r, g, b or (null)
+        colour = body_end + 1
+        if colour == len(buffer):
+            # Usually the whole command, with no colour, but the colour may be on its way
+            self.settling = True
+            return None, 0
+        if buffer.startswith(b'(null)', colour):
+            return colour + 6, self.terminator_length(colour + 6)
+        if b'(null)'.startswith(bytes(buffer[colour:colour + 6])):
+            return None, 0
+        if buffer[colour] in b'rgb' and not self.starts_command(colour):
+            return colour + 1, self.terminator_length(colour + 1)
+        return colour, self.terminator_length(colour)
+
+    def body_end(self, position):
+        # Just past the JSON object starting here, or None while it is still open
+        buffer = self.buffer
+        if position == len(buffer):
+            return None
+        if buffer[position] != ord('{'):
+            # Not a body we understand, it runs to the end of the line
+            while position < len(buffer) and buffer[position] not in self.terminators:
+                position += 1
+            return position
+        depth = 0
+        quoted = False
+        escaped = False
+        while position < len(buffer):
+            character = buffer[position]
+            if quoted:
+                if escaped:
+                    escaped = False
+                elif character == ord('\\'):
+                    escaped = True
+                elif character == ord('"'):
+                    quoted = False
+            elif character == ord('"'):
+                quoted = True
+            elif character == ord('{'):
+                depth += 1
+            elif character == ord('}'):
+                depth -= 1
+                if depth == 0:
+                    return position + 1
+            elif character in self.terminators:
+                # A line ending in the middle of a body, let the command fail rather than wait for ever
+                return position
+            position += 1
+        return None
+
+    def terminator_length(self, position):
+        # CR, LF or CRLF straight after a command are part of it
+        if position >= len(self.buffer) or self.buffer[position] not in self.terminators:
+            return 0
+        if self.buffer[position:position + 2] == b'\r\n':
+            return 2
+        return 1
+
+
+class SavantClient:
+    # One connected Savant host. Everything for it is queued with write() and sent by its own writer thread,
+    # so a slow host only ever delays itself. The queue is bounded: once it is full, waiting updates to the same
+    # resource are collapsed into the newest and then the oldest messages dropped, and a host that stays behind
+    # or stops accepting data altogether is disconnected
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.protocol = savant_protocol
+        self.pace = savant_pace
+        self.running = True
+        self.outbound = deque()
+        self.ready = threading.Condition()
+        self.connected = time.time()
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.send_max = 0.0
+        self.collapsed = 0
+        self.dropped = 0
+        self.behind_since = None
+        self.sending_since = None
+
+    def write(self, message):
+        with self.ready:
+            self.enqueue(message)
+            self.ready.notify()
+        self.check_lag()
+
+    def enqueue(self, message):
+        # Called with self.ready held
+        if len(self.outbound) >= savant_client_queue:
+            self.make_room()
+        self.outbound.append(message)
+
+    def make_room(self):
+        # Called with self.ready held
+        if self.behind_since is None:
+            self.behind_since = time.time()
+            logger.warning("#W4418 Client %s has fallen %s messages behind" % (self.address[0], len(self.outbound)))
+        kept = []
+        positions = {}
+        for message in self.outbound:
+            if isinstance(message, ProtocolMessage):
+                key = (message.message_type, message.device_id)
+                if key in positions:
+                    # The newest state wins, sent where the first update for the resource was waiting
+                    kept[positions[key]] = kept[positions[key]].merge(message)
+                    continue
+                positions[key] = len(kept)
+            kept.append(message)
+        self.collapsed += len(self.outbound) - len(kept)
+        self.outbound.clear()
+        self.outbound.extend(kept)
+        if len(self.outbound) >= savant_client_queue:
+            # Nothing much to collapse, drop the oldest quarter rather than one message per write
+            while len(self.outbound) > savant_client_queue * 3 // 4:
+                self.outbound.popleft()
+                self.dropped += 1
+
+    def check_lag(self):
+        now = time.time()
+        if self.behind_since is not None and now - self.behind_since > savant_client_lag:
+            reason = 'has been behind for more than %s seconds' % savant_client_lag
+        elif self.sending_since is not None and now - self.sending_since > savant_send_timeout:
+            reason = 'has not accepted any data for %s seconds' % savant_send_timeout
+        else:
+            return
+        if self.running:
+            logger.warning("#W6702 Disconnecting client %s, it %s" % (self.address[0], reason))
+            metrics.count('client_evictions')
+            self.close()
+
+    def sent(self, messages, data, seconds):
+        self.sent_messages += messages
+        self.sent_bytes += len(data)
+        self.send_max = max(self.send_max, seconds)
+        metrics.observe('client_send', seconds)
+        metrics.count('client_bytes', len(data))
+
+    def metrics(self):
+        with self.ready:
+            queued = len(self.outbound)
+        return {'address': '%s:%s' % tuple(self.address[:2]), 'protocol': self.protocol, 'pace': self.pace,
+                'connected': round(time.time() - self.connected), 'queued': queued,
+                'messages': self.sent_messages, 'bytes': self.sent_bytes, 'send_max': round(self.send_max, 4),
+                'collapsed': self.collapsed, 'dropped': self.dropped,
+                'behind': round(time.time() - self.behind_since, 1) if self.behind_since is not None else 0}
+
+    def encode(self, message):
+        if isinstance(message, bytes):
+            # Already encoded, such as a state snapshot
+            return message
+        if isinstance(message, ProtocolMessage):
+            message = message.line(self.protocol)
+            if message is None:
+                return b''
+        elif not isinstance(message, str):
+            logger.debug("#D6116 Message format not right as string, formatting for JSON")
+            message = json.dumps(str(message))
+        return (message + '\r\n').encode()
+
+    def take(self):
+        with self.ready:
+            if self.pace and len(self.outbound) <= savant_backlog:
+                return [self.outbound.popleft()]
+            # Unpaced, or a paced client that has fallen behind: send everything waiting in one write
+            pending = list(self.outbound)
+            self.outbound.clear()
+            # Caught up
+            self.behind_since = None
+            return pending
+
+    def writer(self):
+        while True:
+            with self.ready:
+                while self.running and not self.outbound:
+                    self.ready.wait()
+                if not self.running:
+                    break
+                pending = self.take()
+            data = b''.join([self.encode(message) for message in pending])
+            if data:
+                try:
+                    started = time.perf_counter()
+                    self.sending_since = time.time()
+                    self.connection.sendall(data)
+                    self.sending_since = None
+                    self.sent(len(pending), data, time.perf_counter() - started)
+                except socket.error as err_AC:
+                    logger.warning("#W6143 Sending to client %s failed: %s" % (self.address[0], err_AC))
+                    self.close()
+                    break
+            if self.pace:
+                time.sleep(self.pace)
+        logger.debug("#D3390 Writer for client %s finished" % self.address[0])
+
+    def close(self):
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+        try:
+            # Wakes up the client's listener if it is blocked in recv()
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class AsyncSavantClient(SavantClient):
+    # A Savant connection served by AsyncCommunicationServer. write() may be called from any thread
+    def __init__(self, stream_writer, address, loop):
+        SavantClient.__init__(self, stream_writer.get_extra_info('socket'), address)
+        self.stream_writer = stream_writer
+        self.loop = loop
+        self.wake = asyncio.Event()
+
+    def write(self, message):
+        with self.ready:
+            self.enqueue(message)
+        self.check_lag()
+        try:
+            self.loop.call_soon_threadsafe(self.wake.set)
+        except RuntimeError:
+            # The event loop has already been closed
+            pass
+
+    async def writer(self):
+        while self.running:
+            await self.wake.wait()
+            self.wake.clear()
+            while self.running and self.outbound:
+                pending = self.take()
+                data = b''.join([self.encode(message) for message in pending])
+                if data:
+                    try:
+                        started = time.perf_counter()
+                        self.sending_since = time.time()
+                        self.stream_writer.write(data)
+                        await asyncio.wait_for(self.stream_writer.drain(), savant_send_timeout)
+                        self.sending_since = None
+                        self.sent(len(pending), data, time.perf_counter() - started)
+                    except asyncio.TimeoutError:
+                        logger.warning("#W8357 Disconnecting client %s, it has not accepted any data for %s seconds"
+                                       % (self.address[0], savant_send_timeout))
+                        metrics.count('client_evictions')
+                        self.close()
+                        break
+                    except (socket.error, ConnectionError) as err_AD:
+                        logger.warning("#W2771 Sending to client %s failed: %s" % (self.address[0], err_AD))
+                        self.close()
+                        break
+                if self.pace:
+                    await asyncio.sleep(self.pace)
+        logger.debug("#D7315 Writer for client %s finished" % self.address[0])
+
+    def close(self):
+        with self.ready:
+            self.running = False
+        try:
+            self.loop.call_soon_threadsafe(self.wake.set)
+            self.loop.call_soon_threadsafe(self.stream_writer.close)
+        except RuntimeError:
+            pass
+
+
+class CommandRunner:
+    # Runs Savant commands on a pool of workers, so a host's connection keeps reading while the bridge answers
+    # and one host can have several commands in flight. Commands for the same light, group or list still run
+    # one at a time, in the order they arrived. A command that returns a Future, such as one waiting in a
+    # batch, frees its worker, and the next command for the same key starts once that Future is done
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def submit(self, key, task, *args):
+        with self.lock:
+            waiting = self.queues.get(key)
+            if waiting is not None:
+                # Already being worked through, it will get to this one
+                waiting.append((task, args))
+                return
+            self.queues[key] = deque([(task, args)])
+        self.pool.submit(self.work, key)
+
+    def work(self, key):
+        while True:
+            with self.lock:
+                waiting = self.queues[key]
+                if not waiting:
+                    del self.queues[key]
+                    return
+                task, args = waiting.popleft()
+            try:
+                outcome = task(*args)
+            except Exception as err_AL:
+                logger.error("#E1582 Command worker caught an error: %s" % err_AL, exc_info=True)
+                continue
+            if isinstance(outcome, Future) and not outcome.done():
+                # Commands that arrive for this key meanwhile queue up behind it, as self.queues still has it
+                outcome.add_done_callback(lambda done: self.resume(key))
+                return
+
+    def resume(self, key):
+        try:
+            self.pool.submit(self.work, key)
+        except RuntimeError:
+            # Shutting down
+            pass
+
+    def depth(self):
+        with self.lock:
+            return sum(len(waiting) for waiting in self.queues.values())
+
+    def stop(self):
+        self.pool.shutdown(wait=False)
 
 
 class CommunicationServer(threading.Thread):
@@ -177,6 +1030,8 @@ class CommunicationServer(threading.Thread):
         self.lock = threading.Lock()
         self.message_queue = message_queue
         self.httpcomms = http_communications
+        self.runner = CommandRunner(savant_command_workers)
+        self.supervisor = Supervisor('server')
         while connection_loop:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_address = ('0.0.0.0', server_port)
@@ -200,400 +1055,1374 @@ class CommunicationServer(threading.Thread):
         logger.debug("#D8461 Savant communications server started successfully")
 
     def run(self):
-        logger.debug("#D9621 setting up the message queue processor")
-        queue_processor = threading.Thread(target=self.process_queue, args=())
-        queue_processor.setDaemon(True)
         logger.debug("#D5417 Starting the message queue processor")
-        queue_processor.start()
-        logger.debug("#D8644 Message queue processor started, adding a record of thread to threads array")
-        self.lock.acquire()
-        self.threads.append(queue_processor)
-        self.lock.release()
+        self.supervisor.add('fan_out', self.process_queue, generational=True)
         logger.debug("#D7604 Starting the HTTP communications server")
         self.httpcomms.start()
         logger.debug("#D6547 Setting up queue watcher")
-        watcher = threading.Thread(target=self.queue_watcher, args=())
-        watcher.setDaemon(True)
-        watcher.start()
+        self.supervisor.add('watcher', self.queue_watcher)
+        self.supervisor.add('listener', self.accept_connections)
+        self.supervisor.wait()
+        logger.info("#I0472 Closing CommunicationsServer")
+        self.sock.close()
+
+    def accept_connections(self):
         while self.running:
             logger.debug("#D2395 Setting up a Savant connection listener")
             listen_process = threading.Thread(target=self.listen_messages, args=(self.sock.accept()))
             listen_process.setDaemon(True)
-            logger.debug("#D6125 Starting the Savant connection listener")
-            listen_process.start()
+            # Recorded before it starts, as a connection that closes at once removes itself straight away
             logger.debug("#D9793 Adding connection listener to threads array")
             self.lock.acquire()
             self.threads.append(listen_process)
             self.lock.release()
-        logger.info("#I0472 Closing CommunicationsServer")
-        self.sock.close()
+            logger.debug("#D6125 Starting the Savant connection listener")
+            listen_process.start()
 
     def queue_watcher(self):
-        global server_running
-        while True:
-            self.message_queue.put("queue_test")
-            time.sleep(5)
-            if self.queue_test:
-                logger.debug("#D5831 Message queue responded and should be working")
-                self.queue_test = False
+        # Only the message processor is replaced, Savant connections and the store are left alone
+        while not self.supervisor.stopping.is_set():
+            try:
+                # A stuck processor with a full queue would block a plain put(), and the watcher with it
+                self.message_queue.put("queue_test", timeout=5)
+            except Full:
+                self.recover_fan_out('the message queue is full')
             else:
-                server_running = False
-                logger.warning("W5297 Server needs to be restarted, Message Queue has stopped responding")
-            time.sleep(300)
+                if self.supervisor.stopping.wait(5):
+                    break
+                if self.queue_test:
+                    logger.debug("#D5831 Message queue responded and should be working")
+                    self.queue_test = False
+                else:
+                    self.recover_fan_out('the message queue has stopped responding')
+            self.supervisor.stopping.wait(300)
 
-    def process_queue(self):
-        global server_running
+    def recover_fan_out(self, reason):
+        self.supervisor.replace('fan_out', reason)
+
+    def process_queue(self, generation):
         logger.debug("#D4268 Message queue processor started")
-        while True:
+        while self.supervisor.current('fan_out', generation):
             try:
-                message = self.message_queue.get()
-                logger.debug("#D8480 Message received: %s" % message)
-                if message == 'shutdown':
-                    logger.debug("#D2738 Message 'Shutdown' received. Closing communications servers.")
-                    self.running = False
-                    logger.debug("#D1842 Force a new connection to break connection listener")
-                    sock2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock2.connect(self.server_address)
-                    time.sleep(1)
+                # Wake up now and then, so a replaced processor that was only waiting for messages stops
+                message = self.message_queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                # One taken just as this processor was replaced is still sent, then this one stops
+                if not self.dispatch(message):
                     break
-                if message == 'restart':
-                    logger.debug("#D2492 Restart requested from message queue")
-                    server_running = False
-                elif message == 'queue_test':
-                    if verbose:
-                        logger.debug("#D8296 Responding to queue test with true")
-                    self.queue_test = True
-                else:
-                    for client in self.clients:
-                        try:
-                            logger.debug("#D2710 Sending received message to client")
-                            client.send((message + '\r\n').encode())
-                            time.sleep(0.1)
-                        except TypeError:
-                            logger.debug("#D6116 Message format not right as string, formatting for JSON. "
-                                         "Sending to client")
-                            client.send((json.dumps(str(message)) + '\r\n').encode())
-                            time.sleep(0.1)
-                        except Exception as err_C:
-                            logger.error("E1868 Message format issue: %s" % err_C)
             except Exception as err_B:
+                # One bad message, carry on with the next
                 logger.error("#E5461 Message Queue had a problem processing a message: %s" % err_B, exc_info=True)
-                call(["service", "hue-coprocessor", "restart"])
-        self.lock.acquire()
-        logger.debug("#D9720 Removing message processor from threads array")
-        self.threads.remove(threading.currentThread())
-        self.lock.release()
         logger.debug("#D5465 Finishing message processor thread")
 
+    def dispatch(self, message):
+        # Returns False once the server is shutting down
+        global server_running
+        logger.debug("#D8480 Message received: %s" % message)
+        if message == 'shutdown':
+            logger.debug("#D2738 Message 'Shutdown' received. Closing communications servers.")
+            self.shutdown()
+            return False
+        if message == 'restart':
+            logger.debug("#D2492 Restart requested from message queue")
+            server_running = False
+        elif message == 'queue_test':
+            if verbose:
+                logger.debug("#D8296 Responding to queue test with true")
+            self.queue_test = True
+        else:
+            metrics.gauge('message_queue', self.message_queue.qsize())
+            metrics.count('messages')
+            with metrics.timer('fan_out'):
+                for client in list(self.clients):
+                    try:
+                        if verbose:
+                            logger.debug("#D2710 Queueing received message for client %s" % client.address[0])
+                        client.write(message)
+                    except Exception as err_C:
+                        logger.error("E1868 Message format issue: %s" % err_C)
+        return True
+
+    def stats(self):
+        metrics.gauge('message_queue', self.message_queue.qsize())
+        metrics.gauge('commands_waiting', self.runner.depth())
+        with self.lock:
+            clients = list(self.clients)
+        return dict(metrics.report(), clients=[client.metrics() for client in clients],
+                    bridges=self.httpcomms.queue_metrics(),
+                    components=dict(self.supervisor.metrics(), **self.httpcomms.components()))
+
+    def shutdown(self):
+        self.supervisor.stop()
+        self.running = False
+        self.runner.stop()
+        # The command pool is gone, so the connections go too. Each listener tidies up as its recv() returns
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+        logger.debug("#D1842 Force a new connection to break connection listener")
+        sock2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock2.connect(self.server_address)
+        time.sleep(1)
+
     def listen_messages(self, connection, client_address):
+        logger.info('#E8007 %s connected.' % client_address[0])
+        client = SavantClient(connection, client_address)
+        client_writer = threading.Thread(target=client.writer, args=())
+        client_writer.setDaemon(True)
+        client_writer.start()
+        self.lock.acquire()
+        logger.debug("#E4220 Adding new client %s to threads array" % client_address[0])
+        self.clients.append(client)
+        self.lock.release()
         try:
-            logger.info('#E8007 %s connected.' % client_address[0])
-            self.lock.acquire()
-            logger.debug("#E4220 Adding new client %s to threads array" % client_address[0])
-            self.clients.append(connection)
-            self.lock.release()
             logger.debug("#D5767 Sending welcome message to client %s" % client_address[0])
-            connection.send(('#' + 'J14 HTTP-Savant Relay v%s\r\n' % server_version).encode())
+            client.write('#' + 'J14 HTTP-Savant Relay v%s' % server_version)
             time.sleep(2)
             logger.debug("#D8619 Pushing all device states to client %s" % client_address[0])
-            self.httpcomms.new_connect(connection)
-            while True:
-                datarecv = connection.recv(1024)
-                logger.debug("#D4893 Received data from %s" % client_address[0])
-                if not datarecv:
-                    logger.debug("#D0308 Invalid data received from %s. Closing client connection" % client_address[0])
-                    break
-                datarecv = datarecv.decode("utf-8")
-                logger.debug("#D9685 Recieved content of type: %s" % type(datarecv))
-                datarecv = datarecv.replace("\n", "")
-                datarecv = datarecv.replace("\r", "")
-                data = datarecv
-                # if data.encode('hex') == 'fffb06':
-                #     logger.debug("#D3612 Received ^C from client %s. Closing client connection" % client_address[0])
-                #     connection.close()
-                #     break
-                if data == 'close' or data == 'exit' or data == 'quit':
-                    logger.debug("#D1259 Received close, exit, or quit string from client %s. "
-                                 "Closing client connection" % client_address[0])
-                    break
-                if data == 'restart':
-                    logger.debug("#D6629 Received restart string from client %s. "
-                                 "Requesting server restart" % client_address[0])
-                    self.message_queue.put('restart')
-                    break
-                elif data == '':
-                    logger.debug("#D3713 Received empty data string from client %s" % client_address[0])
-                    connection.send("#32" + 'Empty Command String\r\n')
+            self.httpcomms.new_connect(client)
+            framer = CommandFramer()
+            connected = True
+            while connected:
+                # Only wait a moment for the rest of a command that has been split. The deadline is kept here
+                # rather than as a socket timeout, which would also cut short the writer thread's sends
+                wait = framer.wait()
+                if wait is not None and not select.select([connection], [], [], wait)[0]:
+                    logger.debug("#D3105 Client %s went quiet part way through a command" % client_address[0])
+                    commands = framer.flush()
                 else:
-                    try:
-                        logger.debug("#D5443 Received command from client: %s" % client_address[0])
-                        command = data
-                        split_data = command.split('%')
-                        if split_data[2] == '(null)':
-                            del split_data[2]
-                        try:
-                            command = split_data[0]
-                            body = split_data[1]
-                            if len(split_data) == 3:
-                                return_data = self.httpcomms.send_command(cmd_type='put', command=command,
-                                                                          body_content=json.loads(body),
-                                                                          xy=split_data[2])
-                            else:
-                                return_data = self.httpcomms.send_command(cmd_type='put', command=command,
-                                                                          body_content=json.loads(body))
-                            try:
-                                for update in return_data:
-                                    if 'success' in update:
-                                        for key in update['success']:
-                                            keys = key.strip("/").split("/")
-                                            if update['success'][key] == "0":
-                                                mydata = {keys[2]: {keys[3]: update['success'][key]}}
-                                                if keys[3] == "on" and not bool(update['success'][key]):
-                                                    mydata[keys[2]]["bri"] = "0"
-                                                connection.send(('#' + json.dumps(
-                                                    {keys[0].rstrip('s'): {"id": keys[1], "info": mydata}}) + '\r\n').encode())
-                                            else:
-                                                connection.send(('#' + json.dumps(update) + '\r\n').encode())
-                                    else:
-                                        connection.send(('#' + json.dumps(update) + '\r\n').encode())
-                            except TypeError:
-                                connection.send('#' + json.dumps(return_data) + '\r\n')
-
-                        except IndexError:
-                            return_data = self.httpcomms.send_command(cmd_type='get', command=command)
-                            for item in return_data:
-                                if command == "lights":
-                                    if not return_data[item]['state']['on']:
-                                        return_data[item]['state']['bri'] = 0
-                                        return_data[item]['state']['hue'] = 0
-                                        return_data[item]['state']['sat'] = 0
-
-                                    return_me = return_data[item]
-                                elif command == "groups":
-                                    if not return_data[item]["type"] in devicetypes:
-                                        continue
-                                    if not return_data[item]['action']['on']:
-                                        return_data[item]['action']['bri'] = 0
-                                        return_data[item]['action']['hue'] = 0
-                                        return_data[item]['action']['sat'] = 0
-                                    return_me = return_data[item]
-                                elif command == "scenes":
-                                    if len(return_data[item]["appdata"]) < 0:
-                                        continue
-                                    return_me = {"name": return_data[item]["name"],
-                                                 "lights": ', '.join(return_data[item]["lights"])}
-                                elif command == "sensors":
-                                    if not return_data[item]["modelid"] in devicetypes:
-                                        continue
-                                    return_me = return_data[item]
-                                else:
-                                    return_me = return_data[item]
-                                connection.send(('#' + json.dumps(
-                                    {command.rstrip("s"): {"id": item, "info": return_me}}) + '\r\n').encode())
-                        except TypeError:
-                            logger.debug('#D6939 TypeError, could not process received data from client %s'
-                                         % client_address[0])
-                            connection.send('#E0658 TypeError, could not process received data\r\n')
-
-                    except ValueError:
-                        logger.debug('#D2057 ValueError, could not process received data from client %s'
-                                     % client_address[0])
-                        connection.send('#E7804 ValueError, could not process received data\r\n')
-                    except TypeError:
-                        logger.debug('#D9011 TypeError, could not process received data from client %s'
+                    datarecv = connection.recv(4096)
+                    logger.debug("#D4893 Received data from %s" % client_address[0])
+                    if not datarecv:
+                        logger.debug("#D0308 Invalid data received from %s. Closing client connection"
                                      % client_address[0])
-                        connection.send('#E7223 TypeError, could not process received data\r\n')
-                    except Exception as err_D:
-                        logger.error('#E3017 %s' % err_D, exc_info=True)
-                        connection.send('#E8408 %s\r\n' % err_D)
-
+                        break
+                    commands = framer.feed(datarecv)
+                if len(commands) > 1:
+                    logger.debug("#D7430 Received %s commands from %s at once" % (len(commands), client_address[0]))
+                for data in commands:
+                    if not self.handle_command(client, data):
+                        connected = False
+                        break
+        except (socket.error, ConnectionError) as err_AQ:
+            logger.debug('#D2168 Client %s connection error: %s' % (client_address[0], err_AQ))
+        except Exception as err_E:
+            logger.error('#E0910 %s' % err_E, exc_info=True)
+        finally:
             logger.debug('#D4024 Client %s thread closing' % client_address[0])
             self.lock.acquire()
             logger.debug('#D4694 Removing client %s from clients array, and thread from threads array'
                          % client_address[0])
-            self.clients.remove(connection)
-            self.threads.remove(threading.currentThread())
+            self.clients.remove(client)
+            self.threads.remove(threading.current_thread())
             self.lock.release()
+            client.close()
             connection.close()
             logger.info('#I7373 %s disconnected.' % client_address[0])
+
+    def handle_command(self, client, data):
+        # Returns False once the client should be disconnected
+        if data == 'close' or data == 'exit' or data == 'quit':
+            logger.debug("#D1259 Received close, exit, or quit string from client %s. "
+                         "Closing client connection" % client.address[0])
+            return False
+        if data == 'restart':
+            logger.debug("#D6629 Received restart string from client %s. "
+                         "Requesting server restart" % client.address[0])
+            self.message_queue.put('restart')
+            return False
+        if data.startswith('pace '):
+            try:
+                client.pace = max(0, int(data[5:])) / 1000.0
+                logger.debug("#D1748 Client %s set pacing to %s seconds" % (client.address[0], client.pace))
+                client.write('#' + json.dumps({"pace": int(client.pace * 1000)}))
+            except ValueError:
+                client.write('#E5098 Invalid pace, expected milliseconds')
+            return True
+        if data == 'queue':
+            client.write('#' + json.dumps({"queue": self.httpcomms.queue_metrics()}))
+        elif data == 'stats':
+            client.write('#' + json.dumps({"stats": self.stats()}))
+        elif data == 'delta' or data == 'full':
+            logger.debug("#D2296 Client %s switched to the %s protocol" % (client.address[0], data))
+            client.protocol = data
+            client.write('#' + json.dumps({"protocol": data}))
+        elif data == '':
+            logger.debug("#D3713 Received empty data string from client %s" % client.address[0])
+            client.write("#32" + 'Empty Command String')
+        else:
+            # Bridge commands run on the worker pool, so this connection carries on reading while they wait
+            self.runner.submit(self.command_key(data), self.run_command, client, data)
+        return True
+
+    @staticmethod
+    def command_key(data):
+        # The resource a command is for, so commands for the same light run in order. Alert commands put the body
+        # straight after the path without a %, so cut at whichever comes first
+        return re.split(r'[%{]', data, 1)[0].strip('/')
+
+    def run_command(self, client, data):
+        try:
+            logger.debug("#D5443 Received command from client: %s" % client.address[0])
+            command = data
+            split_data = command.split('%')
+            if len(split_data) > 2 and split_data[2] == '(null)':
+                del split_data[2]
+            try:
+                command = split_data[0]
+                body = split_data[1]
+                if len(split_data) == 3:
+                    return_data = self.httpcomms.send_command(cmd_type='put', command=command,
+                                                              body_content=json.loads(body),
+                                                              xy=split_data[2])
+                else:
+                    return_data = self.httpcomms.send_command(cmd_type='put', command=command,
+                                                              body_content=json.loads(body))
+                if isinstance(return_data, Future):
+                    # Waiting in a batch. The answer goes back once the batch has been sent, without holding
+                    # this worker until then
+                    return_data.add_done_callback(lambda done: self.reply(client, done.result()))
+                    return return_data
+                self.reply(client, return_data)
+
+            except IndexError:
+                cached = self.httpcomms.cached_list(command)
+                if cached is not None:
+                    logger.debug("#D8153 Answering '%s' for client %s from the store"
+                                 % (command, client.address[0]))
+                    for item, return_me in cached:
+                        client.write('#' + json.dumps({command.rstrip("s"): {"id": item, "info": return_me}}))
+                    return
+                return_data = self.httpcomms.send_command(cmd_type='get', command=command, lane='refresh')
+                for item in return_data:
+                    if command == "lights":
+                        if not return_data[item]['state']['on']:
+                            return_data[item]['state']['bri'] = 0
+                            return_data[item]['state']['hue'] = 0
+                            return_data[item]['state']['sat'] = 0
+
+                        return_me = return_data[item]
+                    elif command == "groups":
+                        if not return_data[item]["type"] in devicetypes:
+                            continue
+                        if not return_data[item]['action']['on']:
+                            return_data[item]['action']['bri'] = 0
+                            return_data[item]['action']['hue'] = 0
+                            return_data[item]['action']['sat'] = 0
+                        return_me = return_data[item]
+                    elif command == "scenes":
+                        if len(return_data[item]["appdata"]) < 0:
+                            continue
+                        return_me = {"name": return_data[item]["name"],
+                                     "lights": ', '.join(return_data[item]["lights"])}
+                    elif command == "sensors":
+                        if not return_data[item]["modelid"] in devicetypes:
+                            continue
+                        return_me = return_data[item]
+                    else:
+                        return_me = return_data[item]
+                    client.write('#' + json.dumps(
+                        {command.rstrip("s"): {"id": item, "info": return_me}}))
+            except TypeError:
+                logger.debug('#D6939 TypeError, could not process received data from client %s'
+                             % client.address[0])
+                client.write('#E0658 TypeError, could not process received data')
+
+        except ValueError:
+            logger.debug('#D2057 ValueError, could not process received data from client %s'
+                         % client.address[0])
+            client.write('#E7804 ValueError, could not process received data')
+        except TypeError:
+            logger.debug('#D9011 TypeError, could not process received data from client %s'
+                         % client.address[0])
+            client.write('#E7223 TypeError, could not process received data')
+        except Exception as err_D:
+            logger.error('#E3017 %s' % err_D, exc_info=True)
+            client.write('#E8408 %s' % err_D)
+
+    @staticmethod
+    def reply(client, return_data):
+        try:
+            for update in return_data:
+                if 'success' in update:
+                    for key in update['success']:
+                        keys = key.strip("/").split("/")
+                        if update['success'][key] == "0":
+                            mydata = {keys[2]: {keys[3]: update['success'][key]}}
+                            if keys[3] == "on" and not bool(update['success'][key]):
+                                mydata[keys[2]]["bri"] = "0"
+                            client.write('#' + json.dumps(
+                                {keys[0].rstrip('s'): {"id": keys[1], "info": mydata}}))
+                        else:
+                            client.write('#' + json.dumps(update))
+                else:
+                    client.write('#' + json.dumps(update))
+        except TypeError:
+            client.write('#' + json.dumps(return_data))
+
+
+class AsyncCommunicationServer(CommunicationServer):
+    # Serves every Savant connection, and the fan-out to them, from one asyncio event loop instead of a
+    # thread per connection. Bridge requests are blocking urllib3 calls, so commands run in the loop's executor
+    def __init__(self, message_queue, http_communications):
+        CommunicationServer.__init__(self, message_queue, http_communications)
+        self.loop = None
+        self.stopping = None
+        self.fan_outs = []
+        self.fan_out_generation = 0
+
+    def run(self):
+        logger.debug("#D5034 Starting the HTTP communications server")
+        self.httpcomms.start()
+        logger.debug("#D7103 Setting up queue watcher")
+        self.supervisor.add('watcher', self.queue_watcher)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+        logger.info("#I9376 Closing CommunicationsServer")
+        self.sock.close()
+
+    async def serve(self):
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(self.client_connected, sock=self.sock, backlog=100)
+        logger.debug("#D4551 Savant connections are being served by the event loop")
+        self.start_fan_out()
+        await self.stopping.wait()
+        logger.debug("#D8854 Closing the Savant listener and disconnecting clients")
+        server.close()
+        await server.wait_closed()
+        for client in list(self.clients):
+            client.close()
+        # A replaced fan out may still be waiting on the queue in an executor thread, wake it so it can finish
+        for fan_out in self.fan_outs:
+            if not fan_out.done():
+                try:
+                    self.message_queue.put_nowait('queue_test')
+                except Full:
+                    pass
+        await asyncio.wait(self.fan_outs, timeout=1)
+        for fan_out in self.fan_outs:
+            fan_out.cancel()
+
+    def start_fan_out(self):
+        # Any fan out still running stops after its current message, so only one ever takes from the queue
+        self.fan_out_generation += 1
+        self.fan_outs = [fan_out for fan_out in self.fan_outs if not fan_out.done()]
+        self.fan_outs.append(self.loop.create_task(self.fan_out(self.fan_out_generation)))
+
+    def recover_fan_out(self, reason):
+        logger.warning("#W3127 Replacing the message queue processor, %s" % reason)
+        metrics.count('restarts')
+        self.loop.call_soon_threadsafe(self.start_fan_out)
+
+    async def fan_out(self, generation):
+        logger.debug("#D9823 Message queue processor started")
+        while self.running and generation == self.fan_out_generation:
+            try:
+                message = await self.loop.run_in_executor(None, self.message_queue.get)
+                if not self.dispatch(message):
+                    break
+            except Exception as err_B:
+                logger.error("#E9886 Message Queue had a problem processing a message: %s" % err_B, exc_info=True)
+        logger.debug("#D2839 Finishing message processor")
+
+    def shutdown(self):
+        self.supervisor.stop()
+        self.running = False
+        self.runner.stop()
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def client_connected(self, reader, stream_writer):
+        client_address = stream_writer.get_extra_info('peername')
+        logger.info('#E7617 %s connected.' % client_address[0])
+        client = AsyncSavantClient(stream_writer, client_address, self.loop)
+        client_writer = self.loop.create_task(client.writer())
+        self.lock.acquire()
+        self.clients.append(client)
+        self.lock.release()
+        try:
+            logger.debug("#D8782 Sending welcome message to client %s" % client_address[0])
+            client.write('#' + 'J14 HTTP-Savant Relay v%s' % server_version)
+            await asyncio.sleep(2)
+            logger.debug("#D5861 Pushing all device states to client %s" % client_address[0])
+            self.httpcomms.new_connect(client)
+            framer = CommandFramer()
+            connected = True
+            while connected and client.running:
+                try:
+                    datarecv = await asyncio.wait_for(reader.read(4096), framer.wait())
+                except asyncio.TimeoutError:
+                    logger.debug("#D0684 Client %s went quiet part way through a command" % client_address[0])
+                    commands = framer.flush()
+                else:
+                    if not datarecv:
+                        logger.debug("#D4725 Invalid data received from %s. Closing client connection"
+                                     % client_address[0])
+                        break
+                    commands = framer.feed(datarecv)
+                for data in commands:
+                    if not await self.loop.run_in_executor(None, self.handle_command, client, data):
+                        connected = False
+                        break
+        except (socket.error, ConnectionError) as err_AE:
+            logger.debug('#D6350 Client %s connection error: %s' % (client_address[0], err_AE))
         except Exception as err_E:
-            logger.error('#E0910 %s' % err_E, exc_info=True)
+            logger.error('#E4434 %s' % err_E, exc_info=True)
+        finally:
+            self.lock.acquire()
+            self.clients.remove(client)
+            self.lock.release()
+            client.close()
+            await client_writer
+            logger.info('#I8847 %s disconnected.' % client_address[0])
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.source(), indent=1).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, log_format, *args):
+        if verbose:
+            logger.debug("#D4307 Metrics request: %s" % (log_format % args))
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    # Serves the same numbers as the telnet 'stats' command as JSON on http://127.0.0.1:<port>/metrics
+    daemon_threads = True
+
+    def __init__(self, port, source):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), MetricsHandler)
+        self.source = source
+
+    def start(self):
+        logger.info('#I2291 Serving metrics on http://127.0.0.1:%s/metrics' % self.server_address[1])
+        server = threading.Thread(target=self.serve_forever, name='metrics', args=())
+        server.setDaemon(True)
+        server.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def delay(self, now):
+        # Seconds until a token is available, 0 if one is available now
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class BridgeScheduler:
+    # Every request to the bridge waits here for its turn. Savant commands go before targeted refreshes, which
+    # go before the background poll, and writes are held to the bridge's light and group command budgets.
+    # The last connection slot is kept for Savant commands so a slow poll never holds them up
+    lanes = ('command', 'refresh', 'poll')
+
+    def __init__(self, light_rate, group_rate, concurrency):
+        self.buckets = {'light': TokenBucket(light_rate, light_rate), 'group': TokenBucket(group_rate, 1)}
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.ready = threading.Condition()
+        self.stats = dict((lane, {'depth': 0, 'max_depth': 0, 'sent': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+                          for lane in self.lanes)
+
+    @staticmethod
+    def bucket_for(method, path):
+        if method == 'GET':
+            return None
+        if path.strip('/').split('/')[0] == 'groups':
+            return 'group'
+        return 'light'
+
+    @contextlib.contextmanager
+    def slot(self, lane, bucket=None):
+        waiter = (self.lanes.index(lane), next(self.sequence), bucket)
+        stats = self.stats[lane]
+        queued = time.time()
+        with self.ready:
+            self.waiting.append(waiter)
+            stats['depth'] += 1
+            stats['max_depth'] = max(stats['max_depth'], stats['depth'])
+            delay = self.turn(waiter)
+            while delay != 0:
+                self.ready.wait(delay)
+                delay = self.turn(waiter)
+            self.waiting.remove(waiter)
+            if bucket is not None:
+                self.buckets[bucket].take()
+            self.in_flight += 1
+            waited = time.time() - queued
+            stats['depth'] -= 1
+            stats['sent'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            self.ready.notify_all()
+        if waited > 1:
+            logger.debug("#D6025 Bridge %s request waited %.2f seconds for its turn" % (lane, waited))
+        try:
+            yield
+        finally:
+            with self.ready:
+                self.in_flight -= 1
+                self.ready.notify_all()
+
+    def turn(self, waiter):
+        # 0 when the waiter may go now, None to wait for another request to finish, otherwise how long until
+        # its bucket has a token
+        limit = self.concurrency if waiter[0] == 0 else max(1, self.concurrency - 1)
+        if self.in_flight >= limit:
+            return None
+        now = time.time()
+        own_delay = None
+        for other in sorted(self.waiting):
+            delay = self.buckets[other[2]].delay(now) if other[2] is not None else 0
+            if other is waiter:
+                if delay == 0:
+                    return 0
+                own_delay = delay
+            elif delay == 0:
+                # Someone ahead of this waiter can go now and takes the free slot first
+                return None
+        return own_delay
+
+    def metrics(self):
+        with self.ready:
+            result = {'in_flight': self.in_flight}
+            for lane in self.lanes:
+                stats = self.stats[lane]
+                result[lane] = {'depth': stats['depth'], 'max_depth': stats['max_depth'], 'sent': stats['sent'],
+                                'wait_avg': round(stats['wait_total'] / stats['sent'], 4) if stats['sent'] else 0,
+                                'wait_max': round(stats['wait_max'], 4)}
+            return result
+
+
+class BridgeClient:
+    # The connection pool for one bridge, kept to the scheduler's concurrency so requests never queue twice.
+    # Each lane has its own connect and read timeouts, and a request that couldn't connect, or timed out on a
+    # reply that is safe to ask for again, is retried after a short jittered delay
+    def __init__(self, address, key, size):
+        host, _, port = address.partition(':')
+        self.pool = urllib3.HTTPConnectionPool(host, port=int(port) if port else 80, maxsize=size, block=True)
+        self.prefix = '/api/%s' % key
+        self.size = size
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'in_use': 0, 'max_in_use': 0, 'saturated': 0}
+
+    def request(self, lane, method, path='', body=None):
+        url = self.prefix + ('/' + path.strip('/') if path.strip('/') else '')
+        # lights/3/state is timed as 'PUT lights/state', so every light shares one histogram
+        parts = path.strip('/').split('/')
+        endpoint = '%s %s' % (method, '/'.join(parts[0:1] + parts[2:3]) or 'all')
+        connect, read = bridge_timeouts[lane]
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['in_use'] += 1
+            self.stats['max_in_use'] = max(self.stats['max_in_use'], self.stats['in_use'])
+            if self.stats['in_use'] >= self.size:
+                # This request took the last free connection. The scheduler never lets more than the pool size
+                # through, so this is how often every connection was busy
+                self.stats['saturated'] += 1
+        started = time.perf_counter()
+        try:
+            attempt = 0
+            while True:
+                try:
+                    return self.pool.urlopen(method, url, body=body, retries=False,
+                                             timeout=urllib3.Timeout(connect=connect, read=read))
+                except urllib3.exceptions.HTTPError as err_AJ:
+                    if attempt >= bridge_retries or not self.retryable(method, err_AJ):
+                        with self.lock:
+                            self.stats['failures'] += 1
+                        raise
+                    attempt += 1
+                    delay = bridge_retry_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                    logger.debug("#D5586 %s %s failed (%s), retrying in %.2f seconds" % (method, path, err_AJ, delay))
+                    with self.lock:
+                        self.stats['retries'] += 1
+                time.sleep(delay)
+        finally:
+            metrics.observe('bridge %s' % endpoint, time.perf_counter() - started)
+            with self.lock:
+                self.stats['in_use'] -= 1
+
+    @staticmethod
+    def retryable(method, error):
+        if isinstance(error, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError)):
+            # The request never reached the bridge
+            return True
+        if isinstance(error, (urllib3.exceptions.ReadTimeoutError, urllib3.exceptions.ProtocolError)):
+            # GET and PUT can safely be sent twice, POST creates something each time
+            return method != 'POST'
+        return False
+
+    def metrics(self):
+        with self.lock:
+            result = dict(self.stats)
+        result['connections_opened'] = self.pool.num_connections
+        result['pool_size'] = self.size
+        return result
+
+
+class CommandBatcher(threading.Thread):
+    # Whole-house commands from Savant arrive as one lights/N/state PUT per light, and the bridge rate-limits
+    # them so the lights change one after another. Identical PUTs that arrive within the window are sent as
+    # one action on a group holding exactly those lights, or else one after another within the bridge's
+    # light command budget. Callers get a Future rather than waiting, so a whole-house command bigger than the
+    # command worker pool still lands in one batch
+    def __init__(self, bridge, window):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.bridge = bridge
+        self.window = window
+        self.running = True
+        self.batches = OrderedDict()
+        self.ready = threading.Condition()
+
+    @staticmethod
+    def accepts(command):
+        parts = command.strip('/').split('/')
+        return len(parts) == 3 and parts[0] == 'lights' and parts[2] == 'state'
+
+    def submit(self, light_id, body_content):
+        # A Future for this light's response, done once the batch has been sent
+        key = json.dumps(body_content, sort_keys=True)
+        future = Future()
+        with self.ready:
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = {'body': body_content, 'lights': [], 'results': {}, 'futures': [],
+                         'deadline': time.time() + self.window}
+                self.batches[key] = batch
+                self.ready.notify()
+            if light_id not in batch['lights']:
+                batch['lights'].append(light_id)
+            batch['futures'].append((light_id, future))
+        return future
+
+    def run(self):
+        logger.debug("#D5914 Command batcher started with a %s second window" % self.window)
+        while self.running:
+            with self.ready:
+                if not self.batches:
+                    self.ready.wait()
+                    continue
+                key = next(iter(self.batches))
+                delay = self.batches[key]['deadline'] - time.time()
+                if delay > 0:
+                    self.ready.wait(delay)
+                    continue
+                batch = self.batches.pop(key)
+            try:
+                self.flush(batch)
+            except Exception as err_AF:
+                logger.error("#E6408 Command batch caught an error: %s" % err_AF, exc_info=True)
+            finally:
+                self.answer(batch)
+
+    def stop(self):
+        with self.ready:
+            self.running = False
+            batches = list(self.batches.values())
+            self.batches.clear()
+            self.ready.notify()
+        for batch in batches:
+            self.answer(batch)
+
+    @staticmethod
+    def answer(batch):
+        for light_id, future in batch['futures']:
+            future.set_result(batch['results'].get(light_id, ''))
+
+    def flush(self, batch):
+        lights = batch['lights']
+        group_id = self.bridge.group_for(lights) if len(lights) > 1 else None
+        if group_id is not None:
+            logger.debug("#D3318 Sending %s identical light commands as one action on group %s"
+                         % (len(lights), group_id))
+            result = self.bridge.put_state('groups/%s/action' % group_id, batch['body'])
+            for light_id in lights:
+                batch['results'][light_id] = self.light_result(result, group_id, light_id)
+            return
+        if len(lights) > 1:
+            logger.debug("#D8027 No group matches %s identical light commands, sending them one by one"
+                         % len(lights))
+        for light_id in lights:
+            batch['results'][light_id] = self.bridge.put_state('lights/%s/state' % light_id, batch['body'])
+
+    @staticmethod
+    def light_result(result, group_id, light_id):
+        # Reword the group's response as if the light had been commanded on its own
+        if not isinstance(result, list):
+            return result
+        light_result = []
+        prefix = '/groups/%s/action/' % group_id
+        for update in result:
+            if 'success' in update:
+                light_result.append({'success': dict(
+                    (key.replace(prefix, '/lights/%s/state/' % light_id), value)
+                    for key, value in update['success'].items())})
+            else:
+                light_result.append(update)
+        return light_result
 
 
 class HTTPBridge(threading.Thread):
-    def __init__(self, savant_queue):
+    def __init__(self, savant_queue, address, key, index=0, saved=None):
         threading.Thread.__init__(self)
         self.message_queue = savant_queue
-        self.lock = threading.Lock()
-        self.threads = []
-        self.converter = Converter(gamutc)
+        self.address = address
+        self.key = key
+        self.index = index
+        # Where this bridge's lights, groups and sensors are numbered from in what Savant sees
+        self.offset = index * bridge_id_offset
+        self.workers = OrderedDict([('poller', self.http_poller), ('watcher', self.queue_reporter)])
+        self.supervisor = Supervisor('bridge %s' % address)
+        # Set once this bridge has been replaced by a restart, so its threads wind down
+        self.stopping = threading.Event()
+        self.event_connection = None
+        self.converters = {}
+        self.differ = DiffEngine()
+        self.snapshot = StateSnapshot()
+        self.scheduler = BridgeScheduler(bridge_light_rate, bridge_group_rate, bridge_concurrency)
+        self.client = BridgeClient(address, key, bridge_concurrency)
+        self.batcher = None
+        if batch_window > 0:
+            self.batcher = CommandBatcher(self, batch_window)
+            self.batcher.start()
         self.store = {'lights': {}, "groups": {}, "sensors": {}, "scenes": {}, "all": {}}
-        logger.debug('#D0930 HTTPBridge started')
+        self.last_poll = 0
+        self.last_scene_poll = 0
+        # Hash of the last response for each polled section, so an unchanged one is never parsed
+        self.digests = {}
+        # When each light and group last had a command confirmed by the bridge, so a poll that was already under
+        # way can't put back the state from before it
+        self.confirmed = {}
+        # The state saved by the last run, and the ids it held until a poll shows which are still on the bridge
+        self.saved = saved
+        self.restored = {}
+        # Runs the poller's requests for lights, groups, sensors and scenes side by side
+        self.fetcher = ThreadPoolExecutor(max_workers=4)
+        self.stream_connected = threading.Event()
+        self.resync_requested = threading.Event()
+        # Set by Savant commands and detected changes, so the poller speeds back up
+        self.activity = threading.Event()
+        if http_event_stream:
+            self.workers['events'] = self.event_listener
+        if http_sensor_interval > 0:
+            self.workers['sensors'] = self.sensor_poller
+        logger.debug('#D0930 HTTPBridge for %s started' % self.address)
 
     def run(self):
-        logger.debug('#D1124 Setting up device poller')
-        poller = threading.Thread(target=self.http_poller, args=())
-        poller.setDaemon(True)
-        poller.start()
-        logger.debug('#D6387 Adding device poller thread to threads array')
-        self.lock.acquire()
-        self.threads.append(poller)
-        self.lock.release()
-        logger.debug('#D0868 Setting up poller watcher')
-        watcher = threading.Thread(target=self.thread_watcher, args=())
-        watcher.setDaemon(True)
-        watcher.start()
+        if self.saved:
+            self.restore(self.saved)
+            self.saved = None
+        for name in self.workers:
+            logger.debug('#D1124 Setting up %s thread' % name)
+            self.supervisor.add(name, self.workers[name])
+
+    def stop(self):
+        logger.debug('#D6387 Stopping HTTPBridge for %s' % self.address)
+        self.supervisor.stop()
+        self.stopping.set()
+        # Wake the poller, and the event listener if it is waiting on the bridge
+        self.activity.set()
+        connection = self.event_connection
+        if connection is not None:
+            connection.close()
+        if self.batcher is not None:
+            self.batcher.stop()
+        self.fetcher.shutdown(wait=False)
 
-    def thread_watcher(self):
-        while True:
-            for thread in self.threads:
-                if not thread.is_alive():
-                    logger.error('#E2052 HTTP Poller is not alive!!')
-                    self.threads.remove(thread)
-                    logger.debug('#D0202 Setting up device poller')
-                    poller = threading.Thread(target=self.http_poller, args=())
-                    poller.setDaemon(True)
-                    poller.start()
-                    logger.debug('#D2399 Adding device poller thread to threads array')
-                    self.lock.acquire()
-                    self.threads.append(poller)
-                    self.lock.release()
-            time.sleep(30)
+    def restore(self, saved):
+        # Fill the store from the state saved by the last run, so Savant hosts that connect before the first poll
+        # still get every light, group, sensor and scene. The first poll then only sends what has changed since
+        try:
+            logger.info('#I5094 Restoring %s lights, %s groups and %s sensors for %s from the last run'
+                        % (len(saved.get('lights', {})), len(saved.get('groups', {})), len(saved.get('sensors', {})),
+                           self.address))
+            self.store['all'] = dict(saved)
+            self.prime_colours(saved.get('lights', {}), saved.get('groups', {}))
+            for light_id in saved.get('lights', {}):
+                self.update_light(light_id, saved['lights'][light_id])
+            for group_id in saved.get('groups', {}):
+                self.update_group(group_id, saved['groups'][group_id])
+            for sensor_id in saved.get('sensors', {}):
+                self.update_sensor(sensor_id, saved['sensors'][sensor_id])
+            if 'scenes' in saved:
+                self.update_scenes(saved['scenes'])
+            self.restored = dict((section, set(saved.get(section, {}))) for section in ('lights', 'groups', 'sensors'))
+        except Exception as err_AM:
+            logger.error("#E0513 Restoring the last run's state caught an error: %s" % err_AM, exc_info=True)
+
+    def forget_restored(self, section, current):
+        # Anything restored from disk that the bridge no longer has
+        for device_id in self.restored.pop(section, set()) - set(current):
+            logger.debug("#D5172 %s '%s' was restored but is no longer on the bridge" % (section, device_id))
+            self.store[section].pop(device_id, None)
+            self.snapshot.discard(section, device_id)
+            self.differ.forget(section, device_id)
+
+    def saved_state(self):
+        # What restore() needs to rebuild the store, or None before there is anything to save
+        if not self.store['all'] and not self.store['sensors']:
+            return None
+        # The event stream, write-through and sensors polled on their own only update the per-section stores,
+        # so those are laid over the last full poll
+        state = {'scenes': self.store['all'].get('scenes', {})}
+        for section in ('lights', 'groups', 'sensors'):
+            state[section] = dict(self.store['all'].get(section, {}), **self.store[section])
+        return state
+
+    def queue_reporter(self):
+        # The supervisor restarts any of this bridge's threads that stop, this just logs how the queue is doing
+        while not self.stopping.wait(30):
+            logger.debug('#D7765 Bridge %s request queue: %s' % (self.address, json.dumps(self.queue_metrics())))
+
+    def event_listener(self):
+        # Hue bridges push resource changes over a server-sent event stream (CLIP v2). Its TLS
+        # certificate is self-signed, and urllib3 buffers streamed bodies, so this uses http.client
+        logger.debug('#D3094 Event stream listener started')
+        if http_event_url:
+            url = urlsplit(http_event_url)
+            if self.index:
+                # Further bridges use the override's scheme and path at their own address
+                url = url._replace(netloc=self.address)
+        else:
+            url = urlsplit('https://%s/eventstream/clip/v2' % self.address)
+        while not self.stopping.is_set():
+            connection = None
+            try:
+                if url.scheme == 'https':
+                    connection = http.client.HTTPSConnection(url.netloc, timeout=http_event_timeout,
+                                                             context=ssl._create_unverified_context())
+                else:
+                    connection = http.client.HTTPConnection(url.netloc, timeout=http_event_timeout)
+                self.event_connection = connection
+                connection.request('GET', url.path or '/', headers={'hue-application-key': self.key,
+                                                                    'Accept': 'text/event-stream'})
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise http.client.HTTPException('Event stream returned HTTP %s' % response.status)
+                logger.info('#I5180 Subscribed to bridge event stream at %s' % url.netloc)
+                # Anything that happened while we were disconnected is picked up by one full poll
+                self.resync_requested.set()
+                self.stream_connected.set()
+                data_lines = []
+                while True:
+                    line = response.readline()
+                    if not line:
+                        break
+                    line = line.decode('utf-8').rstrip('\r\n')
+                    if line.startswith('data:'):
+                        data_lines.append(line[5:].strip())
+                    elif line == '' and data_lines:
+                        self.apply_events(json.loads(''.join(data_lines)))
+                        data_lines = []
+                logger.warning('#W4727 Bridge closed the event stream')
+            except (socket.error, http.client.HTTPException, ValueError, AttributeError) as err_AA:
+                if self.stopping.is_set():
+                    break
+                logger.warning('#W0383 Event stream dropped, falling back to polling: %s' % err_AA)
+            except Exception as err_AB:
+                logger.error('#E5370 Event stream caught an error: %s' % err_AB, exc_info=True)
+            finally:
+                self.stream_connected.clear()
+                self.event_connection = None
+                if connection is not None:
+                    connection.close()
+            self.stopping.wait(http_event_retry)
+
+    def apply_events(self, events):
+        for event in events:
+            if event.get('type') in ('add', 'delete'):
+                logger.debug('#D1467 Event stream reported an %s, requesting a full poll' % event.get('type'))
+                self.resync_requested.set()
+                continue
+            for resource in event.get('data', []):
+                patch = self.convert_event(resource)
+                if patch is None:
+                    # Button events and friends have no v1 equivalent here. Only a sensor we have never seen
+                    # is worth a full poll
+                    parts = resource.get('id_v1', '').strip('/').split('/')
+                    if len(parts) == 2 and parts[0] == 'sensors' and not self.known('sensors', parts[1]):
+                        self.resync_requested.set()
+                    continue
+                device, device_id, changes = patch
+                if device_id not in self.store[device]:
+                    # Group 0, zones and other groups Savant doesn't see are reported with every light change,
+                    # only an id the bridge has never told us about means the store is out of date
+                    if not self.known(device, device_id):
+                        logger.debug('#D5539 Event stream reported unknown %s/%s, requesting a full poll'
+                                     % (device, device_id))
+                        self.resync_requested.set()
+                    continue
+                if verbose:
+                    logger.debug('#D6021 Event stream update for %s/%s: %s' % (device, device_id, changes))
+                device_data = copy.deepcopy(self.store[device][device_id])
+                for section in changes:
+                    device_data.setdefault(section, {}).update(changes[section])
+                if device == 'lights':
+                    self.update_light(device_id, device_data)
+                elif device == 'groups':
+                    self.update_group(device_id, device_data)
+                else:
+                    self.update_sensor(device_id, device_data)
+
+    def known(self, device, device_id):
+        # Anything in the last full poll, tracked or not. Group 0 is every light and never listed
+        if device == 'groups' and device_id == '0':
+            return True
+        return device_id in self.store[device] or device_id in self.store['all'].get(device, {})
+
+    @staticmethod
+    def convert_event(resource):
+        # Translate a CLIP v2 resource update into the v1 fields we keep in the store
+        try:
+            device, device_id = resource['id_v1'].strip('/').split('/')[:2]
+        except (KeyError, ValueError):
+            return None
+        if device not in ('lights', 'groups', 'sensors'):
+            return None
+        section = 'action' if device == 'groups' else 'state'
+        changes = {}
+        if 'on' in resource:
+            changes['on'] = resource['on']['on']
+        if 'dimming' in resource:
+            changes['bri'] = max(1, int(round(resource['dimming']['brightness'] * 254 / 100.0)))
+        if 'xy' in resource.get('color', {}):
+            changes['xy'] = [resource['color']['xy']['x'], resource['color']['xy']['y']]
+            changes['colormode'] = 'xy'
+        if resource.get('color_temperature', {}).get('mirek') is not None:
+            changes['ct'] = resource['color_temperature']['mirek']
+            changes['colormode'] = 'ct'
+        if 'motion' in resource:
+            changes['presence'] = resource['motion']['motion']
+        if 'light' in resource:
+            changes['lightlevel'] = resource['light']['light_level']
+        if 'temperature' in resource:
+            changes['temperature'] = int(round(resource['temperature']['temperature'] * 100))
+        patch = {section: changes}
+        if device == 'sensors':
+            patch['config'] = {}
+            if 'enabled' in resource:
+                patch['config']['on'] = resource['enabled']
+            if 'power_state' in resource:
+                patch['config']['battery'] = resource['power_state'].get('battery_level')
+        if resource.get('type') == 'zigbee_connectivity':
+            patch.setdefault('config' if device == 'sensors' else section, {})['reachable'] = \
+                resource.get('status') == 'connected'
+        patch = dict((key, value) for key, value in patch.items() if value)
+        if not patch:
+            return None
+        return device, device_id, patch
 
     def http_poller(self):
         logger.debug('#D2549 Device poller started')
         logger.debug('#D0890 Poller PID: %s' % threading.currentThread().ident)
-        while True:
+        interval = http_poll_interval
+        while not self.stopping.is_set():
+            if self.stream_connected.is_set() and not self.resync_requested.is_set() and \
+                    time.time() - self.last_poll < http_event_resync:
+                # The event stream is feeding the store, only fall back to a full poll once it drops
+                self.stopping.wait(http_poll_interval)
+                continue
             try:
                 if verbose:
-                    logger.debug('#D4899 Asking for device statuses from %s' % http_ip_address)
-                result = self.send_command()
+                    logger.debug('#D4899 Asking for device statuses from %s' % self.address)
+                # Only the parts of the bridge's state that Savant sees, rather than the whole document with its
+                # config, rules and schedules. Scenes rarely change, so they are only fetched now and then
+                sections = ['lights', 'groups']
+                if http_sensor_interval <= 0:
+                    sections.append('sensors')
+                if self.resync_requested.is_set():
+                    # The store may have drifted from the bridge, so parse everything this time
+                    self.digests.clear()
+                    sections.append('scenes')
+                elif time.time() - self.last_scene_poll >= http_scene_interval:
+                    sections.append('scenes')
+                self.resync_requested.clear()
+                started = time.time()
+                cycle = time.perf_counter()
+                result, fetched = self.fetch(sections)
                 if verbose:
                     logger.debug('#D2547 Received update successfully. Processing data...')
-                removekeys = ['config', 'resourcelinks', 'rules', 'schedules']
-                for removekey in removekeys:
-                    try:
-                        del result[removekey]
-                    except KeyError:
-                        pass
-
-                if not self.store['all'] == result:
-                    logger.debug('#D8176 HTTP Data chanced since last poll')
-                    self.store["all"] = copy.deepcopy(result)
-                    #
-                    # Lights
-                    #
-                    for light_id in result.get('lights'):
-                        light_data = result.get('lights').get(light_id)
-
-                        if light_id not in self.store["lights"]:
-                            logger.debug("#D0139 Found a new LightID '%s', adding it to monitored lights" % light_id)
-                            self.store["lights"][light_id] = copy.deepcopy(light_data)
-                        try:
-                            if not self.store["lights"][light_id] == light_data:
-                                logger.debug("#D2000 Light '%s' information has changed"
-                                             % light_id)
-                                self.store["lights"][light_id] = copy.deepcopy(light_data)
-                                logger.debug("#D1820 Notifying all clients of level change for light '%s'"
-                                             % light_id)
-                                if not light_data['state']['on']:
-                                    light_data['state']['bri'] = 0
-                                    light_data['state']['hue'] = 0
-                                    light_data['state']['sat'] = 0
-                                for key in remove_keys:
-                                    try:
-                                        light_data.pop(key, None)
-                                    except KeyError:
-                                        pass
-                                    except IndexError:
-                                        pass
-                                self.message_queue.put('#' + json.dumps(
-                                    {"light": {"id": light_id, "info": light_data}}))
-                                if 'xy' in light_data['state']:
-                                    pntx, pnty = light_data['state']['xy']
-                                    red, green, blue = self.converter.xy_to_rgb(pntx, pnty)
-
-                                    self.message_queue.put('#' + json.dumps(
-                                        {"light_rgb": {"id": light_id, "info": [
-                                            {"color": "r", "value": red},
-                                            {"color": "g", "value": green},
-                                            {"color": "b", "value": blue}
-                                        ]}}
-                                    ))
-                        except Exception as err_F:
-                            logger.error("#E6663 %s" % err_F, exc_info=True)
-                    #
-                    # Groups
-                    #
-                    for group_id in result.get('groups'):
-                        if result.get("groups").get(group_id).get("type") in devicetypes:
-                            group_data = result.get('groups').get(group_id)
-                            if group_id not in self.store["groups"]:
-                                logger.debug("#D2418 Found a new GroupID '%s', adding it to monitored groups"
-                                             % group_id)
-                                self.store["groups"][group_id] = copy.deepcopy(group_data)
-                            try:
-                                if not self.store["groups"][group_id] == group_data:
-                                    logger.debug("#D9999 Group '%s' information has changed"
-                                                 % group_id)
-                                    self.store["groups"][group_id] = copy.deepcopy(group_data)
-                                    logger.debug("#D0908 Notifying all clients of level change for group '%s'"
-                                                 % group_id)
-                                    if not group_data['action']['on']:
-                                        group_data['action']['bri'] = 0
-                                        group_data['action']['hue'] = 0
-                                        group_data['action']['sat'] = 0
-                                    self.message_queue.put('#' + json.dumps(
-                                        {"group": {"id": group_id, "info": group_data}}))
-                                    if 'xy' in group_data['action']:
-                                        pntx, pnty = group_data['action']['xy']
-                                        red, green, blue = self.converter.xy_to_rgb(pntx, pnty)
-
-                                        self.message_queue.put('#' + json.dumps(
-                                            {"group_rgb": {"id": group_id, "info": [
-                                                {"color": "r", "value": red},
-                                                {"color": "g", "value": green},
-                                                {"color": "b", "value": blue}
-                                            ]}}
-                                        ))
-                            except Exception as err_G:
-                                logger.error("#E7134 %s" % err_G, exc_info=True)
-                    #
-                    # Sensors
-                    #
-                    for sensor_id in result.get('sensors'):
-                        if result.get("sensors").get(sensor_id).get("modelid") in devicetypes:
-                            sensor_data = result.get('sensors').get(sensor_id)
-                            if sensor_id not in self.store["sensors"]:
-                                logger.debug("#D0278 Found a new SensorID '%s', adding it to monitored "
-                                             "sensors" % sensor_id)
-                                self.store["sensors"][sensor_id] = copy.deepcopy(sensor_data)
-                            try:
-                                if not self.store["sensors"][sensor_id] == sensor_data:
-                                    logger.debug("#D1170 Sensor '%s' information has changed"
-                                                 % sensor_id)
-                                    self.store["sensors"][sensor_id] = copy.deepcopy(sensor_data)
-                                    logger.debug("#D4421 Notifying all clients of level change for sensor '%s'"
-                                                 % sensor_id)
-                                    for key in remove_keys:
-                                        try:
-                                            sensor_data.pop(key, None)
-                                        except KeyError:
-                                            pass
-                                        except IndexError:
-                                            pass
-                                    self.message_queue.put('#' + json.dumps({
-                                        "sensor": {"id": sensor_id, "info": sensor_data}}))
-                            except Exception as err_H:
-                                logger.error("#E3942 %s" % err_H, exc_info=True)
+
+                if result:
+                    self.store["all"] = dict(self.store["all"], **result)
+                self.prime_colours(result.get('lights', {}), result.get('groups', {}))
+                for light_id in result.get('lights', {}):
+                    if self.confirmed.get(('lights', light_id), 0) < started:
+                        self.update_light(light_id, result['lights'][light_id])
+                    else:
+                        # Skipped for the written-through state, so the next poll must not be skipped as
+                        # unchanged, or the store would never be put right if the bridge settled elsewhere
+                        self.digests.pop('lights', None)
+                for group_id in result.get('groups', {}):
+                    if self.confirmed.get(('groups', group_id), 0) < started:
+                        self.update_group(group_id, result['groups'][group_id])
+                    else:
+                        self.digests.pop('groups', None)
+                for sensor_id in result.get('sensors', {}):
+                    self.update_sensor(sensor_id, result['sensors'][sensor_id])
+                if 'scenes' in result:
+                    self.update_scenes(result['scenes'])
+                for section in list(self.restored):
+                    if section in result:
+                        self.forget_restored(section, result[section])
+                if 'scenes' in fetched:
+                    self.last_scene_poll = time.time()
+                if len(fetched) == len(sections):
+                    self.last_poll = time.time()
+                metrics.observe('poll_cycle', time.perf_counter() - cycle)
 
             except Exception as err_I:
                 logger.error("#E9155 %s" % err_I, exc_info=True)
+            # Poll quickly while things are happening, then back off towards the idle interval
+            if self.activity.is_set():
+                self.activity.clear()
+                interval = http_poll_interval
+            else:
+                interval = min(http_poll_idle, interval * http_poll_backoff)
             if verbose:
-                logger.debug("#D5604 Finished poll. Waiting for next poll.")
-            time.sleep(http_poll_interval)
+                logger.debug("#D5604 Finished poll. Waiting %.1f seconds for next poll." % interval)
+            if self.activity.wait(interval):
+                # Woken by a command, still leave the usual gap after the last poll
+                time.sleep(max(0, http_poll_interval - (time.time() - self.last_poll)))
+
+    def fetch(self, sections):
+        # GET several sections at once over the connection pool. Returns the sections that changed, and every
+        # section the bridge answered
+        futures = [(section, self.fetcher.submit(self.poll_section, section)) for section in sections]
+        result = {}
+        fetched = set()
+        for section, future in futures:
+            try:
+                data = future.result()
+            except Exception as err_AI:
+                logger.warning("#W3365 Polling %s from %s failed: %s" % (section, self.address, err_AI))
+                continue
+            fetched.add(section)
+            if data is not None:
+                result[section] = data
+        return result, fetched
+
+    def poll_section(self, section):
+        # None when the bridge sent back exactly the bytes it sent last time
+        response = self.bridge_request('poll', 'GET', section)
+        digest = hashlib.blake2b(response.data, digest_size=16).digest()
+        if self.digests.get(section) == digest:
+            if verbose:
+                logger.debug("#D6645 %s from %s unchanged, skipping" % (section, self.address))
+            return None
+        data = json_loads(response.data)
+        if not isinstance(data, dict):
+            # An error list, such as an unauthorised key
+            raise ValueError(json.dumps(data))
+        self.digests[section] = digest
+        return data
+
+    def sensor_poller(self):
+        # Motion sensors and switches are fetched on their own, faster cadence so Savant hears about them
+        # promptly even while the full poll has backed off
+        logger.debug('#D3902 Sensor poller started')
+        while not self.stopping.is_set():
+            if not self.stream_connected.is_set():
+                try:
+                    result = self.poll_section('sensors')
+                    if result is not None:
+                        for sensor_id in result:
+                            self.update_sensor(sensor_id, result[sensor_id])
+                        if 'sensors' in self.restored:
+                            self.forget_restored('sensors', result)
+                except Exception as err_AH:
+                    logger.error("#E4026 %s" % err_AH, exc_info=True)
+            self.stopping.wait(http_sensor_interval)
+
+    def update_light(self, light_id, light_data):
+        try:
+            changes = self.differ.diff('lights', light_id, light_data)
+            if changes is None:
+                return
+            self.activity.set()
+            if light_id not in self.store["lights"]:
+                logger.debug("#D0139 Found a new LightID '%s', adding it to monitored lights" % light_id)
+            else:
+                logger.debug("#D2000 Light '%s' information has changed: %s" % (light_id, list(changes)))
+            self.store["lights"][light_id] = light_data
+            logger.debug("#D1820 Notifying all clients of level change for light '%s'"
+                         % light_id)
+            info = self.format_light(light_data)
+            message = ProtocolMessage('light', self.savant_id(light_id), info, self.delta_info(info, changes, 'state'))
+            self.message_queue.put(message)
+            lines = [message.line()]
+            if 'xy' in light_data['state']:
+                rgb = self.rgb_message('light_rgb', light_id, light_data['state']['xy'])
+                lines.append(rgb.line())
+                if 'xy' in changes.get('state', {}):
+                    self.message_queue.put(rgb)
+            self.snapshot.set('lights', light_id, lines)
+        except Exception as err_F:
+            logger.error("#E6663 %s" % err_F, exc_info=True)
+
+    def update_group(self, group_id, group_data):
+        if group_data.get("type") not in devicetypes:
+            return
+        try:
+            changes = self.differ.diff('groups', group_id, group_data)
+            if changes is None:
+                return
+            self.activity.set()
+            if group_id not in self.store["groups"]:
+                logger.debug("#D2418 Found a new GroupID '%s', adding it to monitored groups"
+                             % group_id)
+            else:
+                logger.debug("#D9999 Group '%s' information has changed: %s" % (group_id, list(changes)))
+            self.store["groups"][group_id] = group_data
+            logger.debug("#D0908 Notifying all clients of level change for group '%s'"
+                         % group_id)
+            info = self.savant_group(self.format_group(group_data))
+            message = ProtocolMessage('group', self.savant_id(group_id), info, self.delta_info(info, changes, 'action'))
+            self.message_queue.put(message)
+            lines = [message.line()]
+            if 'xy' in group_data['action']:
+                rgb = self.rgb_message('group_rgb', group_id, group_data['action']['xy'])
+                lines.append(rgb.line())
+                if 'xy' in changes.get('action', {}):
+                    self.message_queue.put(rgb)
+            self.snapshot.set('groups', group_id, lines)
+        except Exception as err_G:
+            logger.error("#E7134 %s" % err_G, exc_info=True)
+
+    def update_sensor(self, sensor_id, sensor_data):
+        if sensor_data.get("modelid") not in devicetypes:
+            return
+        try:
+            changes = self.differ.diff('sensors', sensor_id, sensor_data)
+            if changes is None:
+                return
+            self.activity.set()
+            if sensor_id not in self.store["sensors"]:
+                logger.debug("#D0278 Found a new SensorID '%s', adding it to monitored "
+                             "sensors" % sensor_id)
+            else:
+                logger.debug("#D1170 Sensor '%s' information has changed: %s" % (sensor_id, list(changes)))
+            self.store["sensors"][sensor_id] = sensor_data
+            logger.debug("#D4421 Notifying all clients of level change for sensor '%s'"
+                         % sensor_id)
+            info = self.format_sensor(sensor_data)
+            message = ProtocolMessage('sensor', self.savant_id(sensor_id), info,
+                                      self.delta_info(info, changes, 'state'))
+            self.message_queue.put(message)
+            self.snapshot.set('sensors', sensor_id, [message.line()])
+        except Exception as err_H:
+            logger.error("#E3942 %s" % err_H, exc_info=True)
+
+    def update_scenes(self, scenes):
+        # Scenes are only sent to Savant when it connects, so they just keep the snapshot current
+        try:
+            for scene_id, scene_data in scenes.items():
+                if not scene_data.get("appdata"):
+                    self.snapshot.discard('scenes', scene_id)
+                    continue
+                if self.differ.diff('scenes', scene_id, scene_data) is None:
+                    continue
+                self.snapshot.set('scenes', scene_id, ['#' + json.dumps({"scene": {"id": scene_id, "info": {
+                    "name": scene_data["name"], "lights": ', '.join(map(self.savant_id, scene_data["lights"]))}}})])
+            for scene_id in self.snapshot.ids('scenes'):
+                if scene_id not in scenes:
+                    logger.debug("#D6840 Scene '%s' has been removed" % scene_id)
+                    self.snapshot.discard('scenes', scene_id)
+                    self.differ.forget('scenes', scene_id)
+        except Exception as err_AG:
+            logger.error("#E2718 %s" % err_AG, exc_info=True)
+
+    @staticmethod
+    def format_light(light_data):
+        # Savant wants brightness, hue and saturation zeroed while a light is off. This builds a new dict
+        # rather than touching the stored one, which is shared with store['all']
+        info = dict((key, value) for key, value in light_data.items() if key not in remove_keys)
+        info['state'] = dict(light_data['state'])
+        if not info['state']['on']:
+            info['state']['bri'] = 0
+            info['state']['hue'] = 0
+            info['state']['sat'] = 0
+        return info
+
+    @staticmethod
+    def format_group(group_data):
+        info = dict(group_data)
+        info['action'] = dict(group_data['action'])
+        if not info['action']['on']:
+            info['action']['bri'] = 0
+            info['action']['hue'] = 0
+            info['action']['sat'] = 0
+        return info
 
-    def send_command(self, cmd_type='get', command='', body_content=None, xy=None):
+    @staticmethod
+    def format_sensor(sensor_data):
+        return dict((key, value) for key, value in sensor_data.items() if key not in remove_keys)
+
+    @staticmethod
+    def delta_info(info, changes, section):
+        # Pick the changed fields out of the formatted resource, so the zeroing Savant expects still applies.
+        # Turning a resource on or off also changes the brightness, hue and saturation Savant sees
+        delta = {}
+        for key in changes:
+            if key not in info:
+                continue
+            if isinstance(changes[key], dict) and isinstance(info[key], dict):
+                fields = set(changes[key])
+                if key == section and 'on' in fields:
+                    fields.update(('bri', 'hue', 'sat'))
+                delta[key] = dict((field, info[key][field]) for field in info[key] if field in fields)
+            else:
+                delta[key] = info[key]
+        return delta
+
+    def cached_list(self, command):
+        # Answers a Savant request for a whole list from the store, filtered the same way as the poller, while
+        # the store is younger than store_max_age. None sends the request on to the bridge
+        if store_max_age <= 0 or command not in ('lights', 'groups', 'sensors', 'scenes'):
+            return None
+        if not self.stream_connected.is_set() and time.time() - self.last_poll > store_max_age:
+            return None
+        if command == 'scenes' and time.time() - self.last_scene_poll > store_max_age:
+            # Scenes are only fetched every http_scene_interval, and the event stream doesn't carry them
+            return None
+        if command == 'lights':
+            return [(self.savant_id(light_id), self.format_light(light_data))
+                    for light_id, light_data in list(self.store['lights'].items())]
+        if command == 'groups':
+            return [(self.savant_id(group_id), self.savant_group(self.format_group(group_data)))
+                    for group_id, group_data in list(self.store['groups'].items())]
+        if command == 'sensors':
+            return [(self.savant_id(sensor_id), self.format_sensor(sensor_data))
+                    for sensor_id, sensor_data in list(self.store['sensors'].items())]
+        return [(scene_id, {"name": scene_data["name"], "lights": ', '.join(map(self.savant_id, scene_data["lights"]))})
+                for scene_id, scene_data in list(self.store['all'].get('scenes', {}).items())
+                if scene_data.get("appdata")]
+
+    def savant_id(self, device_id):
+        if self.offset and device_id.isdigit():
+            return str(int(device_id) + self.offset)
+        return device_id
+
+    def savant_group(self, info):
+        if self.offset:
+            info['lights'] = [self.savant_id(light_id) for light_id in info.get('lights', [])]
+        return info
+
+    def savant_path(self, path):
+        # '/lights/4/state/bri' on the second bridge is '/lights/1004/state/bri' to Savant
+        parts = path.split('/')
+        for position in range(len(parts) - 1):
+            if parts[position] in ('lights', 'groups', 'sensors'):
+                parts[position + 1] = self.savant_id(parts[position + 1])
+        return '/'.join(parts)
+
+    def savant_result(self, result):
+        # The bridge's response to a command, with its addresses moved into the merged namespace
+        if not self.offset or not isinstance(result, list):
+            return result
+        translated = []
+        for update in result:
+            if isinstance(update.get('success'), dict):
+                update = {'success': dict((self.savant_path(key), value) for key, value in update['success'].items())}
+            elif 'address' in update.get('error', {}):
+                update = {'error': dict(update['error'], address=self.savant_path(update['error']['address']))}
+            translated.append(update)
+        return translated
+
+    def savant_list(self, command, result):
+        # A whole list fetched from this bridge, with ids moved into the merged namespace
+        merged = {}
+        for item, data in result.items():
+            if command == 'scenes':
+                merged[item] = dict(data, lights=[self.savant_id(light_id) for light_id in data.get('lights', [])])
+            elif command == 'groups':
+                merged[self.savant_id(item)] = self.savant_group(dict(data))
+            else:
+                merged[self.savant_id(item)] = data
+        return merged
+
+    def light_converter(self, light_data):
+        # One converter per model and gamut, using the gamut the bridge reports for the light. Bridges that
+        # don't report capabilities get gamut C as before
+        control = light_data.get('capabilities', {}).get('control', {})
+        key = (light_data.get('modelid'), control.get('colorgamuttype'))
+        converter = self.converters.get(key)
+        if converter is None:
+            if control.get('colorgamut'):
+                gamut = tuple(xypoint(*point) for point in control['colorgamut'])
+            else:
+                gamut = color_gamuts.get(control.get('colorgamuttype'), gamutc)
+            logger.debug("#D4471 Using gamut %s for model %s" % (key[1], key[0]))
+            converter = self.converters.setdefault(key, Converter(gamut))
+        return converter
+
+    def group_converter(self, group_data, lights=None):
+        # Groups take the gamut of their first colour light
+        if lights is None:
+            lights = self.store['lights']
+        for light_id in group_data.get('lights', []):
+            light_data = lights.get(light_id, {})
+            if 'xy' in light_data.get('state', {}):
+                return self.light_converter(light_data)
+        return self.light_converter({})
+
+    def prime_colours(self, lights, groups):
+        # Converts every colour in one call per gamut so the rgb messages that follow are table lookups
+        batches = {}
+        for light in lights.values():
+            if 'xy' in light.get('state', {}):
+                batches.setdefault(self.light_converter(light), []).append(light['state']['xy'])
+        for group in groups.values():
+            if 'xy' in group.get('action', {}):
+                batches.setdefault(self.group_converter(group, lights), []).append(group['action']['xy'])
+        for converter, points in batches.items():
+            converter.xy_to_rgb_many(points)
+
+    def rgb_message(self, message_type, device_id, xy):
+        if message_type == 'light_rgb':
+            converter = self.light_converter(self.store['lights'].get(device_id, {}))
+        else:
+            converter = self.group_converter(self.store['groups'].get(device_id, {}))
+        red, green, blue = converter.xy_to_rgb(xy[0], xy[1])
+        return ProtocolMessage(message_type, self.savant_id(device_id), [
+            {"color": "r", "value": red},
+            {"color": "g", "value": green},
+            {"color": "b", "value": blue}
+        ])
+
+    def send_command(self, cmd_type='get', command='', body_content=None, xy=None, lane='command'):
         result = ''
         if body_content is None:
             body_content = {}
@@ -601,8 +2430,7 @@ class HTTPBridge(threading.Thread):
             if cmd_type == 'get':
                 if command:
                     try:
-                        result = json.loads(http_req.request('GET', 'http://%s/api/%s/%s' % (http_ip_address, http_key,
-                                                                                             command), timeout=4).data)
+                        result = json_loads(self.bridge_request(lane, 'GET', command).data)
                         if verbose:
                             logger.debug("#D9455 Sent command (%s) to controller" % command)
                     except urllib3.exceptions.HTTPError:
@@ -614,8 +2442,7 @@ class HTTPBridge(threading.Thread):
                                      (command, err_J), exc_info=True)
                 else:
                     try:
-                        result = json.loads(http_req.request('GET', "http://%s/api/%s" % (http_ip_address, http_key),
-                                                             timeout=4).data)
+                        result = json_loads(self.bridge_request(lane, 'GET').data)
                         if verbose:
                             logger.debug("#D5451 Command ('State Poll') sent successfully")
                     except urllib3.exceptions.HTTPError:
@@ -629,17 +2456,19 @@ class HTTPBridge(threading.Thread):
                 if xy:
                     part_a = command.split('/')
                     if part_a[0] == 'lights':
+                        converter = self.light_converter(self.store[part_a[0]][part_a[1]])
                         pntx, pnty = self.store[part_a[0]][part_a[1]]['state']['xy']
                     else:
+                        converter = self.group_converter(self.store[part_a[0]][part_a[1]])
                         pntx, pnty = self.store[part_a[0]][part_a[1]]['action']['xy']
-                    cur_r, cur_g, cur_b = self.converter.xy_to_rgb(pntx, pnty)
+                    cur_r, cur_g, cur_b = converter.xy_to_rgb(pntx, pnty)
                     if xy == "r":
-                        pntxx, pntyy = self.converter.rgb_to_xy(body_content['bri'], cur_g, cur_b)
+                        pntxx, pntyy = converter.rgb_to_xy(body_content['bri'], cur_g, cur_b)
                     elif xy == "g":
-                        pntxx, pntyy = self.converter.rgb_to_xy(cur_r, body_content['bri'], cur_b)
+                        pntxx, pntyy = converter.rgb_to_xy(cur_r, body_content['bri'], cur_b)
                     else:
                         # xy == "b" - assumed
-                        pntxx, pntyy = self.converter.rgb_to_xy(cur_r, cur_g, body_content['bri'])
+                        pntxx, pntyy = converter.rgb_to_xy(cur_r, cur_g, body_content['bri'])
                     body_content = {'on': True, 'xy': [pntxx, pntyy]}
                 elif "bri" in body_content:
                     if "transitiontime" in body_content and isinstance(body_content['transitiontime'], float):
@@ -647,28 +2476,17 @@ class HTTPBridge(threading.Thread):
                     if body_content['bri'] < 1:
                         body_content['on'] = False
                         del body_content['bri']
-                try:
-                    result = json.loads(http_req.request('PUT', "http://%s/api/%s/%s" %
-                                                         (http_ip_address, http_key, command),
-                                                         body=json.dumps(body_content), timeout=4).data)
-                    if verbose:
-                        logger.debug("#D7207 Sent command (%s - %s) to controller" % (command,
-                                                                                      json.dumps(body_content)))
-                except urllib3.exceptions.HTTPError:
-                    logger.error("#E5411 Command ('%s') HTTP Error" % command)
-                except ValueError:
-                    logger.error("#E0786 Command ('%s') JSON Value Error" % command)
-                except TypeError:
-                    logger.error("#E8080 Command ('%s') JSON Type Error" % command)
-                except Exception as err_L:
-                    logger.error("#E4663 Command ('%s') Caught an error: %s" %
-                                 (command, err_L), exc_info=True)
+                if self.batcher is not None and not xy and self.batcher.accepts(command):
+                    # Colour commands are worked out from each light's own colour, so they are never batched
+                    result = self.batcher.submit(command.split('/')[1], body_content)
+                else:
+                    result = self.put_state(command, body_content, lane)
+                self.activity.set()
             else:
                 if command:
                     try:
-                        result = json.loads(http_req.request('POST', "http://%s/api/%s/%s" %
-                                                             (http_ip_address, http_key, command),
-                                                             body=json.dumps(body_content), timeout=4).data)
+                        result = json.loads(self.bridge_request(lane, 'POST', command,
+                                                                body=json.dumps(body_content)).data)
                         if verbose:
                             logger.debug("#D7492 Sent command (%s - %s) to controller" % (command,
                                                                                           json.dumps(body_content)))
@@ -685,8 +2503,7 @@ class HTTPBridge(threading.Thread):
                         logger.debug("#D1701 Command ('%s') sent successfully" % command)
                 else:
                     try:
-                        result = json.loads(http_req.request('GET', "http://%s/api/%s" % (http_ip_address, http_key),
-                                                             body=json.dumps(body_content), timeout=4).data)
+                        result = json_loads(self.bridge_request(lane, 'GET', body=json.dumps(body_content)).data)
                         if verbose:
                             logger.debug("#D3329 Command ('State Poll') sent successfully")
                     except urllib3.exceptions.HTTPError:
@@ -702,119 +2519,230 @@ class HTTPBridge(threading.Thread):
             logger.error("#E4933 Error sending Command. HTTP Request failed. %s" % err_O, exc_info=True)
             self.message_queue.put('#' + "Invalid HTTP command")
 
-    def new_connect(self, connection):
-        logger.debug("#E1154 New client connected. Sending all device states")
-        #
-        # Lights
-        #
+    def bridge_request(self, lane, method, path='', body=None):
+        with self.scheduler.slot(lane, self.scheduler.bucket_for(method, path)):
+            return self.client.request(lane, method, path, body)
+
+    def queue_metrics(self):
+        return dict(self.scheduler.metrics(), pool=self.client.metrics())
+
+    def components(self):
+        return self.supervisor.metrics()
+
+    def put_state(self, command, body_content, lane='command'):
+        result = ''
         try:
-            for light_id in self.store['lights']:
-                light_data = self.store['lights'][light_id]
-                if not light_data['state']['on']:
-                    light_data['state']['bri'] = 0
-                    light_data['state']['hue'] = 0
-                    light_data['state']['sat'] = 0
-                for key in remove_keys:
-                    try:
-                        light_data.pop(key, None)
-                    except KeyError:
-                        pass
-                    except IndexError:
-                        pass
-                connection.send(('#' + json.dumps({"light": {"id": light_id, "info": light_data}}) + '\r\n').encode())
-                if 'xy' in light_data['state']:
-                    pntx, pnty = light_data['state']['xy']
-                    red, green, blue = self.converter.xy_to_rgb(pntx, pnty)
-
-                    self.message_queue.put('#' + json.dumps(
-                        {"light_rgb": {"id": light_id, "info": [
-                            {"color": "r", "value": red},
-                            {"color": "g", "value": green},
-                            {"color": "b", "value": blue}
-                        ]}}
-                    ))
-        except KeyError:
-            logger.error('#E4092 No Light info to send')
-        except socket.error as err_Z:
-            logger.error("#E6782 socket.error: %s" % err_Z, exc_info=True)
-            # Finish the function as nothing more will work
-            return None
-        except Exception as err_Z:
-            logger.error("#E9683 Sending Lights to client caught an error: %s" % err_Z, exc_info=True)
-        #
-        # Groups
-        #
+            result = json.loads(self.bridge_request(lane, 'PUT', command, body=json.dumps(body_content)).data)
+            if verbose:
+                logger.debug("#D7207 Sent command (%s - %s) to controller" % (command,
+                                                                              json.dumps(body_content)))
+        except urllib3.exceptions.HTTPError:
+            logger.error("#E5411 Command ('%s') HTTP Error" % command)
+        except ValueError:
+            logger.error("#E0786 Command ('%s') JSON Value Error" % command)
+        except TypeError:
+            logger.error("#E8080 Command ('%s') JSON Type Error" % command)
+        except Exception as err_L:
+            logger.error("#E4663 Command ('%s') Caught an error: %s" %
+                         (command, err_L), exc_info=True)
         try:
-            for group_id in self.store['groups']:
-                group_data = self.store['groups'][group_id]
-                if not group_data['action']['on']:
-                    group_data['action']['bri'] = 0
-                    group_data['action']['hue'] = 0
-                    group_data['action']['sat'] = 0
-                connection.send(('#' + json.dumps({"group": {"id": group_id, "info": group_data}}) + '\r\n').encode())
-                # self.message_queue.put('#' + json.dumps({"group": {"id": group_id, "info": group_data}}))
-                if 'xy' in group_data['action']:
-                    pntx, pnty = group_data['action']['xy']
-                    red, green, blue = self.converter.xy_to_rgb(pntx, pnty)
-
-                    self.message_queue.put('#' + json.dumps(
-                        {"group_rgb": {"id": group_id, "info": [
-                            {"color": "r", "value": red},
-                            {"color": "g", "value": green},
-                            {"color": "b", "value": blue}
-                        ]}}
-                    ))
-        except KeyError:
-            logger.error('#E1435 No Group info to send')
-        except socket.error as err_P:
-            logger.error("#E8313 socket.error: %s" % err_P, exc_info=True)
-            # Finish the function as nothing more will work
-            return None
-        except Exception as err_Q:
-            logger.error("#E7062 Sending Group to client caught an error: %s" % err_Q, exc_info=True)
-        #
-        # Sensors
-        #
+            self.write_through(result)
+        except Exception as err_AK:
+            logger.error("#E3176 Applying the response to ('%s') caught an error: %s" % (command, err_AK),
+                         exc_info=True)
+        return result
+
+    def write_through(self, result):
+        # Apply what the bridge confirmed straight to the store, so every client hears about it now rather than
+        # after the next poll, and that poll then finds nothing new to send
+        if not isinstance(result, list):
+            return
+        patches = OrderedDict()
+        for update in result:
+            if not isinstance(update, dict) or not isinstance(update.get('success'), dict):
+                continue
+            for key, value in update['success'].items():
+                parts = key.strip('/').split('/')
+                if len(parts) != 4 or parts[0] not in ('lights', 'groups') or parts[3] not in confirmed_fields:
+                    continue
+                changes = patches.setdefault((parts[0], parts[1]), {})
+                changes[parts[3]] = value
+                if confirmed_fields[parts[3]] is not None:
+                    changes['colormode'] = confirmed_fields[parts[3]]
+        for (device, device_id), changes in patches.items():
+            if device == 'groups':
+                # The bridge passes a group's action on to each of its lights
+                if device_id == '0':
+                    members = list(self.store['lights'])
+                else:
+                    members = self.store['groups'].get(device_id, {}).get('lights', [])
+                for light_id in members:
+                    self.confirm('lights', light_id, changes)
+            self.confirm(device, device_id, changes)
+
+    def confirm(self, device, device_id, changes):
+        if device_id not in self.store[device]:
+            return
+        if verbose:
+            logger.debug("#D8840 Bridge confirmed %s/%s: %s" % (device, device_id, changes))
+        self.confirmed[(device, device_id)] = time.time()
+        device_data = copy.deepcopy(self.store[device][device_id])
+        device_data.setdefault('state' if device == 'lights' else 'action', {}).update(changes)
+        if device == 'lights':
+            self.update_light(device_id, device_data)
+        else:
+            self.update_group(device_id, device_data)
+
+    def group_for(self, lights):
+        # An existing group holding exactly these lights, if there is one. Group 0 is every light on the bridge
+        wanted = set(lights)
+        if wanted == set(self.store['lights']):
+            return '0'
+        for group_id, group_data in self.store['all'].get('groups', {}).items():
+            if set(group_data.get('lights', [])) == wanted:
+                return group_id
+        return None
+
+
+class BridgeSet:
+    # Every bridge the CoProcessor manages, presented to Savant as one. Lights, groups and sensors on bridge n are
+    # numbered from n * bridge_id_offset, so a single bridge keeps its own ids. Commands go to the bridge that
+    # owns the id, and scenes to the bridge that holds the scene
+    def __init__(self, bridges):
+        self.bridges = bridges
+        self.stopping = threading.Event()
+        self.saved_version = None
+
+    def start(self):
+        for bridge in self.bridges:
+            bridge.start()
+        if state_save_interval > 0:
+            saver = threading.Thread(target=self.state_saver, name='saver', args=())
+            saver.setDaemon(True)
+            saver.start()
+
+    def stop(self):
+        self.stopping.set()
+        if state_save_interval > 0:
+            self.save_state()
+        for bridge in self.bridges:
+            bridge.stop()
+
+    def components(self):
+        components = {}
+        for bridge in self.bridges:
+            components.update(bridge.components())
+        return components
+
+    def state_saver(self):
+        while not self.stopping.wait(state_save_interval):
+            self.save_state()
+
+    def save_state(self):
+        # Only written when something Savant would be sent has changed
+        version = [bridge.snapshot.version for bridge in self.bridges]
+        if version == self.saved_version:
+            return
+        bridges = {}
+        for bridge in self.bridges:
+            state = bridge.saved_state()
+            if state is not None:
+                bridges[bridge.address] = state
+        if not bridges:
+            return
         try:
-            for sensor_id in self.store['sensors']:
-                sensor_data = self.store['sensors'][sensor_id]
-                for key in remove_keys:
-                    try:
-                        del self.store['sensors'][sensor_id][key]
-                        # sensor_id.pop(key, None)
-                    except KeyError:
-                        pass
-                    except IndexError:
-                        pass
-                connection.send(('#' + json.dumps({"sensor": {"id": sensor_id, "info": sensor_data}}) + '\r\n').encode())
-                # self.message_queue.put('#' + json.dumps({"sensor": {"id": sensor_id, "info": sensor_data}}))
-        except KeyError:
-            logger.error('#E6132 No Sensor info to send')
-        except socket.error as err_R:
-            logger.error("#E8114 socket.error: %s" % err_R, exc_info=True)
-            # Finish the function as nothing more will work
-            return None
-        except Exception as err_S:
-            logger.error("#E2635 Sending Sensors to client caught an error: %s" % err_S, exc_info=True)
-        #
-        # Scenes
-        #
+            save_state({'saved': int(time.time()), 'bridges': bridges})
+            self.saved_version = version
+        except (IOError, OSError, ValueError) as err_AN:
+            logger.warning("#W2064 Unable to save the state to %s: %s" % (state_file, err_AN))
+
+    def owner(self, device_id):
+        index = int(device_id) // bridge_id_offset
+        if index >= len(self.bridges):
+            return None, device_id
+        return self.bridges[index], str(int(device_id) % bridge_id_offset)
+
+    def scene_owner(self, scene_id):
+        for bridge in self.bridges:
+            if scene_id in bridge.store['all'].get('scenes', {}):
+                return bridge
+        return None
+
+    def send_command(self, cmd_type='get', command='', body_content=None, xy=None, lane='command'):
+        if len(self.bridges) == 1:
+            return self.bridges[0].send_command(cmd_type, command, body_content, xy, lane)
+        parts = command.strip('/').split('/')
+        if cmd_type == 'get' and len(parts) == 1 and parts[0] in ('lights', 'groups', 'sensors', 'scenes'):
+            merged = {}
+            for bridge in self.bridges:
+                result = bridge.send_command(cmd_type, command, body_content, xy, lane)
+                if isinstance(result, dict):
+                    merged.update(bridge.savant_list(parts[0], result))
+            return merged
+        if len(parts) < 2 or (parts[0] != 'scenes' and not parts[1].isdigit()):
+            # The full state, and anything without an id, comes from the first bridge
+            return self.bridges[0].send_command(cmd_type, command, body_content, xy, lane)
+        if parts[0] == 'scenes':
+            bridge = self.scene_owner(parts[1])
+        elif parts[0] == 'groups' and isinstance(body_content, dict) and 'scene' in body_content:
+            # Recall the scene on the bridge that holds it, in the requested group if it is on the same bridge
+            bridge = self.scene_owner(body_content['scene'])
+            group_bridge, parts[1] = self.owner(parts[1])
+            if group_bridge is not bridge:
+                parts[1] = '0'
+        elif parts[0] == 'groups' and parts[1] == '0':
+            # Every light on every bridge
+            results = []
+            for bridge in self.bridges:
+                result = bridge.send_command(cmd_type, command, dict(body_content or {}), xy, lane)
+                results.extend(bridge.savant_result(result) or [])
+            return results
+        else:
+            bridge, parts[1] = self.owner(parts[1])
+        if bridge is None:
+            logger.debug("#D7386 No bridge holds '%s'" % command)
+            return [{"error": {"type": 3, "address": '/' + command.strip('/'),
+                               "description": "resource, /%s, not available" % command.strip('/')}}]
+        return self.translated(bridge, bridge.send_command(cmd_type, '/'.join(parts), body_content, xy, lane))
+
+    @staticmethod
+    def translated(bridge, result):
+        if not isinstance(result, Future):
+            return bridge.savant_result(result)
+        # A batched light command, translated once the batch has been sent
+        translated = Future()
+        result.add_done_callback(lambda done: translated.set_result(bridge.savant_result(done.result())))
+        return translated
+
+    def cached_list(self, command):
+        merged = []
+        for bridge in self.bridges:
+            cached = bridge.cached_list(command)
+            if cached is None:
+                return None
+            merged.extend(cached)
+        return merged
+
+    def queue_metrics(self):
+        if len(self.bridges) == 1:
+            return self.bridges[0].queue_metrics()
+        return dict((bridge.address, bridge.queue_metrics()) for bridge in self.bridges)
+
+    def new_connect(self, client):
+        logger.debug("#E1154 New client connected. Sending all device states")
         try:
-            for scene_id in self.store['all']['scenes']:
-                scene_data = self.store['all']['scenes'][scene_id]
-                if len(scene_data["appdata"]) > 0:
-                    connection.send(('#' + json.dumps({"scene": {"id": scene_id, "info": {
-                        "name": scene_data["name"], "lights": ', '.join(scene_data["lights"])}}}) + '\r\n').encode())
-                    # self.message_queue.put('#' + json.dumps({"scene": {"id": scene_id, "info": {
-                    #    "name": scene_data["name"], "lights": ', '.join(scene_data["lights"])}}}))
-        except KeyError:
-            logger.error('#E0652 No Scene info to send')
-        except socket.error as err_T:
-            logger.error("#E3559 socket.error: %s" % err_T, exc_info=True)
-            # Finish the function as nothing more will work
-            return None
-        except Exception as err_U:
-            logger.error("#E4272 Sending Scenes to client caught an error: %s" % err_U, exc_info=True)
+            if client.pace:
+                # A paced client still gets one line at a time
+                for bridge in self.bridges:
+                    for line in bridge.snapshot.lines():
+                        client.write(line)
+            else:
+                data = b''.join([bridge.snapshot.buffer() for bridge in self.bridges])
+                logger.debug("#D0457 Sending state snapshot version %s (%s bytes)"
+                             % ('/'.join([str(bridge.snapshot.version) for bridge in self.bridges]), len(data)))
+                client.write(data)
+        except Exception as err_Z:
+            logger.error("#E9683 Sending device states to client caught an error: %s" % err_Z, exc_info=True)
 
         logger.debug("#D3476 Finished sending information to client")
 
@@ -834,12 +2762,27 @@ class SingleLevelFilter(logging.Filter):
 
 def run():
     global server_running
+    metrics_server = None
+    httpcomms = None
     queue = Queue(maxsize=100)
+    bridge_queue = queue
+    if coalesce_window > 0:
+        bridge_queue = MessageCoalescer(queue, coalesce_window)
+        bridge_queue.start()
     try:
         logger.debug("#D3571 Starting the HTTP communications thread")
-        httpcomms = HTTPBridge(queue)
+        saved = load_state()
+        httpcomms = BridgeSet([HTTPBridge(bridge_queue, address, key, index, saved.get(address))
+                               for index, (address, key) in enumerate(hue_bridges)])
         logger.debug("#D9699 Starting the Savant communications thread")
-        CommunicationServer(queue, httpcomms).start()
+        if savant_asyncio:
+            server = AsyncCommunicationServer(queue, httpcomms)
+        else:
+            server = CommunicationServer(queue, httpcomms)
+        server.start()
+        if metrics_port:
+            metrics_server = MetricsServer(metrics_port, server.stats)
+            metrics_server.start()
         while server_running:
             time.sleep(5)
         queue.put('shutdown')
@@ -854,6 +2797,12 @@ def run():
     finally:
         logger.debug("#D7856 Hit end of 'run()' function")
         queue.put('shutdown')
+        if bridge_queue is not queue:
+            bridge_queue.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if httpcomms is not None:
+            httpcomms.stop()
 
 
 def discover_http():
@@ -926,11 +2875,65 @@ def load_settings(ip_address, key, cur_settings=None):
                 logger.error('#E3223 Unable to set API key, shutting down')
                 raise SystemExit
 
-    settings_data = {"key": http_key, "internalipaddress": http_ip_address}
+    settings_data = dict(cur_settings, key=http_key, internalipaddress=http_ip_address)
     with open(settings_file, 'w') as set_file:
         json.dump(settings_data, set_file)
 
 
+def load_state():
+    # The state saved by the last run, by bridge address, if it is recent enough to be worth showing
+    if state_save_interval <= 0:
+        return {}
+    try:
+        with open(state_file, 'r') as fp:
+            state = json_loads(fp.read())
+    except (IOError, OSError):
+        return {}
+    except ValueError as err_AO:
+        logger.warning("#W7316 Ignoring unreadable state file %s: %s" % (state_file, err_AO))
+        return {}
+    if not isinstance(state, dict) or time.time() - state.get('saved', 0) > state_max_age:
+        logger.debug("#D3984 State file %s is too old to use" % state_file)
+        return {}
+    return state.get('bridges', {})
+
+
+def save_state(state):
+    # Written to a temporary file and renamed over the old one, so a crash part way through never leaves
+    # a half written state behind
+    temporary = state_file + '.tmp'
+    with open(temporary, 'w') as fp:
+        json.dump(state, fp, separators=(',', ':'))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temporary, state_file)
+
+
+def load_bridges(entries):
+    # Further bridges given as KEY@ADDRESS, or just ADDRESS to use the key saved for it or register a new one
+    try:
+        with open(settings_file, 'r') as set_file:
+            saved_settings = json.load(set_file)
+    except (IOError, ValueError):
+        saved_settings = {}
+    keys = saved_settings.get('bridges', {})
+    bridges = []
+    for entry in entries:
+        key, _, address = entry.rpartition('@')
+        if not key:
+            key = keys.get(address) or register_api_key(address)
+            if not key:
+                logger.error('#E8526 Unable to set API key for bridge %s, shutting down' % address)
+                raise SystemExit
+        keys[address] = key
+        bridges.append((address, key))
+    if entries:
+        saved_settings['bridges'] = keys
+        with open(settings_file, 'w') as set_file:
+            json.dump(saved_settings, set_file)
+    return bridges
+
+
 if __name__ == '__main__':
     home = expanduser("~")
     # Argument parser and options
@@ -944,17 +2947,57 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--file', help="Logging File path",
                         required=False, default="%s/http-savant.log" % home)
     parser.add_argument('-P', '--port', help="Port to start the telnet server on (for Savant communication)",
-                        required=False, default=8085)
+                        required=False, default=8085, type=int)
     parser.add_argument('-k', '--key', help="HTTP API Key",
                         required=False, default="")
     parser.add_argument('-a', '--address', help="HTTP API IP address",
                         required=False, default="")
     parser.add_argument('-i', '--interval', help="HTTP API device status polling interval (in seconds)",
                         required=False, default=1.0)
+    parser.add_argument('-I', '--idle', help="Slowest polling interval to back off to while nothing is changing "
+                                             "(in seconds, defaults to the polling interval)",
+                        required=False, default=None, type=float)
+    parser.add_argument('--sensorinterval', help="Poll sensors on their own at this interval (in seconds, 0 to "
+                                                 "poll them with everything else)",
+                        required=False, default=0, type=float)
     parser.add_argument('-m', '--maxrecon', help="Maximum number of restarts after script crash",
-                        required=False, default=100)
+                        required=False, default=100, type=int)
     parser.add_argument('-r', '--recontime', help="First reconnect delay",
-                        required=False, default=2)
+                        required=False, default=2, type=int)
+    parser.add_argument('-e', '--events', help="Subscribe to the HTTP API event stream and only fall back to "
+                                               "polling while the stream is down",
+                        required=False, action='store_true')
+    parser.add_argument('--eventurl', help="Override the HTTP API event stream URL",
+                        required=False, default="")
+    parser.add_argument('-p', '--protocol', help="Default Savant protocol: 'full' resends whole resources, "
+                                                 "'delta' only the fields that changed. Clients can switch by "
+                                                 "sending 'full' or 'delta' after connecting",
+                        required=False, default="full", choices=['full', 'delta'])
+    parser.add_argument('--pace', help="Default delay between messages to each Savant client (in milliseconds). "
+                                       "Clients can set their own with 'pace <ms>'",
+                        required=False, default=0, type=int)
+    parser.add_argument('--asyncio', help="Serve all Savant connections from one asyncio event loop "
+                                          "instead of a thread per connection",
+                        required=False, action='store_true')
+    parser.add_argument('-w', '--window', help="Collapse repeated updates to the same light, group or sensor "
+                                               "within this many milliseconds into one (0 to disable)",
+                        required=False, default=0, type=int)
+    parser.add_argument('-b', '--batch', help="Gather identical light commands arriving within this many "
+                                              "milliseconds into one group action (0 to disable)",
+                        required=False, default=0, type=int)
+    parser.add_argument('-s', '--maxage', help="Answer Savant requests for the light, group, sensor and scene "
+                                               "lists from the last poll while it is younger than this many "
+                                               "seconds (0 to always ask the bridge)",
+                        required=False, default=0, type=float)
+    parser.add_argument('-x', '--bridge', help="Add another bridge as KEY@ADDRESS, or ADDRESS to register a new "
+                                               "key. Its ids are numbered from 1000, 2000 and so on",
+                        required=False, action='append', default=[])
+    parser.add_argument('--statesave', help="Save the last known state of every device this often (in seconds), "
+                                            "and start from it after a restart (0 to disable)",
+                        required=False, default=60, type=float)
+    parser.add_argument('--metrics', help="Serve request, poll and client metrics as JSON on "
+                                          "http://127.0.0.1:<port>/metrics (0 to disable)",
+                        required=False, default=0, type=int)
     parser.add_argument('-t', '--type', help="Add multiple arguments to increase the sensor, "
                                              "and group types we are looking for",
                         required=False, action='append', type=str)
@@ -980,9 +3023,61 @@ if __name__ == '__main__':
 
     # Set up some global variables
     server_port = args.port
+    savant_protocol = args.protocol
+    savant_pace = args.pace / 1000.0
+    savant_asyncio = args.asyncio
+    coalesce_window = args.window / 1000.0
+    batch_window = args.batch / 1000.0
+    store_max_age = args.maxage
+    # The bridge handles roughly 10 light commands and 1 group command a second
+    bridge_light_rate = 10
+    bridge_group_rate = 1
+    bridge_concurrency = 3
+    # Savant ids are numbers, so each further bridge gets the next block of them
+    bridge_id_offset = 1000
+    # Connect and read timeouts for each kind of bridge request, and how often and how soon to retry one that
+    # failed to connect or timed out
+    bridge_timeouts = {'command': (1.0, 2.0), 'refresh': (1.0, 4.0), 'poll': (2.0, 4.0)}
+    bridge_retries = 2
+    bridge_retry_delay = 0.1
+    # Fields a successful command updates in the store straight away, and the colour mode each one implies
+    confirmed_fields = {'on': None, 'bri': None, 'hue': 'hs', 'sat': 'hs', 'xy': 'xy', 'ct': 'ct', 'effect': None}
+    # A paced client with more than this many messages waiting gets them in a single write
+    savant_backlog = 20
+    # Seconds to wait for the rest of a command that arrived in pieces before trying it as it is
+    savant_frame_timeout = 0.5
+    # Seconds to hold a command that looks complete but could still go on, such as 'lights' or 'pace 1'
+    savant_frame_settle = 0.05
+    # Savant commands that can wait on the bridge at once, across every connection
+    savant_command_workers = 16
+    # A part of the CoProcessor that fails is restarted after this many seconds, doubling up to the maximum
+    # while it keeps failing. One that has run for supervisor_stable seconds starts again from the shortest delay
+    supervisor_backoff = 0.1
+    supervisor_backoff_max = 30
+    supervisor_stable = 60
+    # Messages each Savant client may have waiting, how long it may stay behind once it has filled that, and
+    # how long a single write to it may take, before it is disconnected
+    savant_client_queue = 1000
+    savant_client_lag = 30
+    savant_send_timeout = 10
+    metrics_port = args.metrics
+    metrics = Metrics()
     http_ip_address = args.address
     http_key = args.key
     http_poll_interval = float(args.interval)
+    http_poll_idle = max(http_poll_interval, args.idle or http_poll_interval)
+    # Each quiet poll waits this much longer than the last, up to http_poll_idle
+    http_poll_backoff = 1.5
+    http_sensor_interval = args.sensorinterval
+    http_event_stream = args.events
+    http_event_url = args.eventurl
+    # Seconds before an idle event stream is re-established, between reconnect attempts,
+    # and between the full polls that keep scenes and anything the stream missed in sync
+    http_event_timeout = 300
+    http_event_retry = 5
+    http_event_resync = 300
+    # Seconds between polls of the scene list, which is also fetched whenever a resync is requested
+    http_scene_interval = 60
     max_reconnects = args.maxrecon
     reconnect_delay = args.recontime
     devicetypes = ['SML001', 'Room']
@@ -997,6 +3092,10 @@ if __name__ == '__main__':
         'manufacturername'
     ]
     settings_file = "%s/savant-hue.json" % home
+    state_file = "%s/savant-hue-state.json" % home
+    state_save_interval = args.statesave
+    # A saved state older than this (in seconds) is ignored rather than shown to Savant
+    state_max_age = 24 * 60 * 60
     http_req = urllib3.PoolManager()
 
     # Start fresh log file
@@ -1032,9 +3131,15 @@ if __name__ == '__main__':
     logger.debug("#D0328 Logging level = %s" % args.log)
     logger.debug("#D7044 Logfile = %s" % args.file)
     logger.debug("#D5563 Server Port = %s" % args.port)
+    logger.debug("#D0542 Savant protocol = %s" % args.protocol)
     logger.debug("#D3559 HTTP key = %s" % http_key)
     logger.debug("#D6628 HTTP IP address = %s" % http_ip_address)
     logger.debug("#D4278 HTTP polling interval = %s" % args.interval)
+    hue_bridges = [(http_ip_address, http_key)] + load_bridges(args.bridge)
+    for bridge_index, (bridge_address, bridge_key) in enumerate(hue_bridges[1:], 1):
+        logger.debug("#D2870 Bridge %s at %s, ids from %s" % (bridge_index, bridge_address,
+                                                             bridge_index * bridge_id_offset))
+    logger.debug("#D7712 HTTP event stream = %s" % args.events)
 
     while True:
         logger.debug("#D9328 Starting main loop")
@@ -1046,8 +3151,8 @@ if __name__ == '__main__':
             except socket.error as err:
                 logger.error('#E2114 Connect error: %s' % err, exc_info=True)
                 reconnect_delay *= 2
-            logger.info('#I1704 Waiting', reconnect_delay, 'seconds before restart.')
-            logger.info('#I6382 Will try', max_reconnects, 'more times before shutdown')
+            logger.info('#I1704 Waiting %s seconds before restart.' % reconnect_delay)
+            logger.info('#I6382 Will try %s more times before shutdown' % max_reconnects)
             max_reconnects -= 1
             time.sleep(reconnect_delay)
             logger.info('#I6266 Restarting...')
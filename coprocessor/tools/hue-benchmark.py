@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+#     'http-Savant Bridge' - Load test
+#     Copyright (C) '2018'  J14 Systems Ltd
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# Runs the CoProcessor against the simulated bridge with a number of simulated Savant hosts, and reports how
+# long bridge changes take to reach every host, how many messages and commands it gets through, and the CPU and
+# memory the CoProcessor used. Everything runs on this machine, no bridge or network is needed. CPU and memory
+# are read from /proc, so they are only reported on Linux. --wholehouse also checks that one host's identical
+# command to every light reaches the bridge as a single group action when the CoProcessor batches commands.
+#
+#   ./hue-benchmark.py -L 100 -G 10 -n 20 -c 20 -t 30
+#   ./hue-benchmark.py -L 50 -n 5 --commands 5 --ratelimit 10 -- --asyncio -e
+#   ./hue-benchmark.py -L 50 -c 0 -t 1 --wholehouse -- -b 200
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import importlib.util
+import threading
+import subprocess
+
+tools = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('hue_bridge_sim', os.path.join(tools, 'hue-bridge-sim.py'))
+sim = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sim)
+
+
+def free_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 1)
+    return {'count': len(samples), 'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99),
+            'max': round(samples[-1] * 1000, 1)}
+
+
+class ChangeLog:
+    # Every brightness the benchmark sets on the bridge, and when, so a client can tell how long it took to hear
+    # about it. Each light cycles through its own brightness values, so a value is never reused while in flight
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changes = {}
+        self.next_bri = {}
+        self.made = 0
+
+    def record(self, light_id):
+        with self.lock:
+            bri = self.next_bri.get(light_id, 1) % 254 + 1
+            self.next_bri[light_id] = bri
+            self.changes[(light_id, bri)] = time.time()
+            self.made += 1
+            return bri
+
+    def made_at(self, light_id, bri):
+        with self.lock:
+            return self.changes.get((light_id, bri))
+
+
+class SavantHost(threading.Thread):
+    # One simulated Savant host. Records when it hears about each change the benchmark made, and optionally
+    # sends its own light commands and times the bridge's answer
+    def __init__(self, port, changes, lights, command_rate):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.connection = socket.create_connection(('127.0.0.1', port))
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.changes = changes
+        self.lights = lights
+        self.command_rate = command_rate
+        self.ready = threading.Event()
+        self.measuring = False
+        self.seen = set()
+        self.latencies = []
+        self.command_times = []
+        self.command_errors = 0
+        self.sent_at = None
+        self.messages = 0
+        self.bytes = 0
+
+    def run(self):
+        if self.command_rate > 0:
+            commander = threading.Thread(target=self.commands, args=())
+            commander.setDaemon(True)
+            commander.start()
+        pending = b''
+        while True:
+            try:
+                data = self.connection.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            received = time.time()
+            if self.measuring:
+                self.bytes += len(data)
+            pending += data
+            lines = pending.split(b'\r\n')
+            pending = lines.pop()
+            for line in lines:
+                self.handle(line, received)
+
+    def handle(self, line, received):
+        if not line.startswith(b'#{') and not line.startswith(b'#['):
+            return
+        if self.measuring:
+            self.messages += 1
+        try:
+            message = json.loads(line[1:].decode('utf-8'))
+        except ValueError:
+            return
+        if 'light' in message:
+            self.ready.set()
+            state = message['light'].get('info', {}).get('state', {})
+            if self.measuring and 'bri' in state:
+                key = (message['light']['id'], state['bri'])
+                made = self.changes.made_at(*key)
+                if made is not None and key not in self.seen:
+                    self.seen.add(key)
+                    self.latencies.append(received - made)
+        elif 'success' in message or 'error' in message:
+            if self.sent_at is not None:
+                if self.measuring:
+                    self.command_times.append(received - self.sent_at)
+                    if 'error' in message:
+                        self.command_errors += 1
+                self.sent_at = None
+
+    def commands(self):
+        self.ready.wait()
+        while True:
+            time.sleep(random.expovariate(self.command_rate))
+            if self.sent_at is not None and time.time() - self.sent_at < 5:
+                # Still waiting for the answer to the last one
+                continue
+            light_id = random.choice(self.lights)
+            self.sent_at = time.time()
+            try:
+                self.connection.sendall(('lights/%s/state%%{"on":true}%%(null)' % light_id).encode())
+            except socket.error:
+                break
+
+    def close(self):
+        try:
+            self.connection.close()
+        except socket.error:
+            pass
+
+
+class ProcessMonitor(threading.Thread):
+    # Samples the CoProcessor's resident memory while it runs, and its CPU time from /proc
+    def __init__(self, pid):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.pid = pid
+        self.running = True
+        self.rss_peak = 0
+        self.rss_samples = []
+
+    def cpu_seconds(self):
+        try:
+            with open('/proc/%s/stat' % self.pid) as fp:
+                fields = fp.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def rss(self):
+        try:
+            with open('/proc/%s/status' % self.pid) as fp:
+                for line in fp:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+        return None
+
+    def run(self):
+        while self.running:
+            rss = self.rss()
+            if rss is not None:
+                self.rss_samples.append(rss)
+                self.rss_peak = max(self.rss_peak, rss)
+            time.sleep(0.5)
+
+
+def change_generator(bridge, changes, rate, stop):
+    light_ids = list(bridge.lights)
+    while not stop.is_set():
+        time.sleep(random.expovariate(rate))
+        light_id = random.choice(light_ids)
+        bridge.set_state('lights', light_id, {'bri': changes.record(light_id)})
+
+
+def whole_house(port, bridge, light_ids):
+    # One host sends the same command to every light in a single write, as a Savant whole-house button does, and
+    # counts what reached the bridge
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.settimeout(0.5)
+    # Let the first full state go by. It only comes after the CoProcessor's welcome pause, so wait for every light
+    # rather than for a quiet moment, or the timer would include that pause
+    unseen = set(light_ids)
+    pending = b''
+    deadline = time.time() + 15
+    while unseen and time.time() < deadline:
+        try:
+            data = connection.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        pending += data
+        lines = pending.split(b'\r\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.startswith(b'#{"light": {"id": "'):
+                unseen.discard(line[19:].split(b'"', 1)[0].decode())
+    # Whatever else the snapshot holds, groups and sensors
+    while True:
+        try:
+            if not connection.recv(65536):
+                break
+        except socket.timeout:
+            break
+    with bridge.lock:
+        before = dict(bridge.puts)
+    started = time.time()
+    connection.sendall(b''.join(b'lights/%s/state%%{"bri": 123}%%(null)' % light_id.encode()
+                                for light_id in light_ids))
+    answered = set()
+    pending = b''
+    deadline = time.time() + 30
+    while len(answered) < len(light_ids) and time.time() < deadline:
+        try:
+            data = connection.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        pending += data
+        lines = pending.split(b'\r\n')
+        pending = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line[1:].decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(message, dict) and isinstance(message.get('success'), dict):
+                for address in message['success']:
+                    parts = address.strip('/').split('/')
+                    if parts[0] == 'lights' and parts[2:] == ['state', 'bri']:
+                        answered.add(parts[1])
+    elapsed = time.time() - started
+    connection.close()
+    with bridge.lock:
+        return {'lights': len(light_ids), 'answered': len(answered), 'ms': round(elapsed * 1000, 1),
+                'light_puts': bridge.puts['lights'] - before['lights'],
+                'group_puts': bridge.puts['groups'] - before['groups']}
+
+
+def wait_for_port(port, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('The CoProcessor exited with code %s' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise SystemExit('The CoProcessor did not start listening on port %s' % port)
+
+
+def benchmark(args, coprocessor_args):
+    bridge = sim.SimulatedBridge(args.lights, args.groups, args.sensors)
+    sim.BridgeRequestHandler.bridge = bridge
+    sim.BridgeRequestHandler.latency = args.latency / 1000.0
+    if args.ratelimit > 0:
+        sim.BridgeRequestHandler.limit = sim.RateLimit(args.ratelimit)
+    bridge_port = free_port()
+    server = sim.ThreadingHTTPServer(('127.0.0.1', bridge_port), sim.BridgeRequestHandler)
+    threading.Thread(target=server.serve_forever, args=(), daemon=True).start()
+
+    savant_port = free_port()
+    workdir = tempfile.mkdtemp(prefix='hue-benchmark-')
+    command = [sys.executable, os.path.join(os.path.dirname(tools), 'hue-coprocessor.py'),
+               '-a', '127.0.0.1:%s' % bridge_port, '-k', 'simulator', '-P', str(savant_port),
+               '-f', os.path.join(workdir, 'http-savant.log'), '-l', args.log]
+    if '-e' in coprocessor_args or '--events' in coprocessor_args:
+        command += ['--eventurl', 'http://127.0.0.1:%s/eventstream/clip/v2' % bridge_port]
+    command += coprocessor_args
+    print('Running %s' % ' '.join(command[1:]))
+    process = subprocess.Popen(command, cwd=workdir, env=dict(os.environ, HOME=workdir))
+    monitor = ProcessMonitor(process.pid)
+    monitor.start()
+    hosts = []
+    house = None
+    stop = threading.Event()
+    try:
+        wait_for_port(savant_port, process, 15)
+        changes = ChangeLog()
+        light_ids = sorted(bridge.lights, key=int)
+        for number in range(args.clients):
+            host = SavantHost(savant_port, changes, light_ids, args.commands)
+            host.start()
+            hosts.append(host)
+        for host in hosts:
+            if not host.ready.wait(30):
+                raise SystemExit('A simulated Savant host was never sent the lights')
+        # Give the CoProcessor a moment to finish sending every host its first full state
+        time.sleep(1)
+
+        cpu_start = monitor.cpu_seconds()
+        started = time.time()
+        for host in hosts:
+            host.measuring = True
+        if args.changes > 0:
+            threading.Thread(target=change_generator, args=(bridge, changes, args.changes, stop),
+                             daemon=True).start()
+        time.sleep(args.time)
+        stop.set()
+        # Let the last changes drain through before counting
+        time.sleep(args.drain)
+        elapsed = time.time() - started
+        cpu_end = monitor.cpu_seconds()
+        for host in hosts:
+            host.measuring = False
+        if args.wholehouse:
+            for host in hosts:
+                host.close()
+            house = whole_house(savant_port, bridge, light_ids)
+    finally:
+        stop.set()
+        monitor.running = False
+        for host in hosts:
+            host.close()
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        server.shutdown()
+
+    latencies = [latency for host in hosts for latency in host.latencies]
+    command_times = [latency for host in hosts for latency in host.command_times]
+    expected = changes.made * len(hosts)
+    report = {
+        'seconds': round(elapsed, 1),
+        'changes': {'made': changes.made, 'delivered': len(latencies), 'expected': expected,
+                    'missed': expected - len(latencies), 'latency_ms': percentiles(latencies)},
+        'commands': {'answered': len(command_times), 'errors': sum(host.command_errors for host in hosts),
+                     'per_second': round(len(command_times) / elapsed, 1),
+                     'refused_by_bridge': sim.BridgeRequestHandler.limit.refused if args.ratelimit > 0 else 0,
+                     'latency_ms': percentiles(command_times)},
+        'throughput': {'messages_per_second': round(sum(host.messages for host in hosts) / elapsed, 1),
+                       'bytes_per_second': round(sum(host.bytes for host in hosts) / elapsed)},
+        'coprocessor': {'cpu_percent': round((cpu_end - cpu_start) / elapsed * 100, 1)
+                        if cpu_start is not None and cpu_end is not None else None,
+                        'rss_peak_mb': round(monitor.rss_peak / 1048576.0, 1) if monitor.rss_peak else None,
+                        'rss_end_mb': round(monitor.rss_samples[-1] / 1048576.0, 1)
+                        if monitor.rss_samples else None},
+        'log': os.path.join(workdir, 'http-savant.log')
+    }
+    if house is not None:
+        report['whole_house'] = house
+    return report
+
+
+def print_report(report):
+    changes = report['changes']
+    commands = report['commands']
+    coprocessor = report['coprocessor']
+    print('Measured for %s seconds' % report['seconds'])
+    print('Bridge changes:  %s made, %s of %s deliveries to Savant hosts (%s missed)'
+          % (changes['made'], changes['delivered'], changes['expected'], changes['missed']))
+    if changes['latency_ms']['count']:
+        print('  change to host: p50 %(p50)s ms, p95 %(p95)s ms, p99 %(p99)s ms, max %(max)s ms'
+              % changes['latency_ms'])
+    print('Savant commands: %s answered (%s/s), %s errors, %s refused by the bridge'
+          % (commands['answered'], commands['per_second'], commands['errors'], commands['refused_by_bridge']))
+    if commands['latency_ms']['count']:
+        print('  round trip:     p50 %(p50)s ms, p95 %(p95)s ms, p99 %(p99)s ms, max %(max)s ms'
+              % commands['latency_ms'])
+    print('Throughput:      %s messages/s, %s bytes/s to all hosts'
+          % (report['throughput']['messages_per_second'], report['throughput']['bytes_per_second']))
+    print('CoProcessor:     %s%% CPU, %s MB peak RSS, %s MB at the end'
+          % (coprocessor['cpu_percent'], coprocessor['rss_peak_mb'], coprocessor['rss_end_mb']))
+    if 'whole_house' in report:
+        print('Whole house:     %(answered)s of %(lights)s lights answered in %(ms)s ms, sent to the bridge as '
+              '%(group_puts)s group actions and %(light_puts)s light commands' % report['whole_house'])
+    print('Log:             %s' % report['log'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test the CoProcessor against a simulated bridge. "
+                                                 "Arguments after -- are passed to the CoProcessor")
+    parser.add_argument('-L', '--lights', help="Number of lights", required=False, default=50, type=int)
+    parser.add_argument('-G', '--groups', help="Number of rooms (and scenes)", required=False, default=5, type=int)
+    parser.add_argument('-S', '--sensors', help="Number of motion sensors", required=False, default=5, type=int)
+    parser.add_argument('-c', '--changes', help="Bridge changes per second", required=False, default=10.0,
+                        type=float)
+    parser.add_argument('--latency', help="Milliseconds added to every bridge reply", required=False, default=0,
+                        type=float)
+    parser.add_argument('--ratelimit', help="Commands the bridge accepts per second (0 for no limit)",
+                        required=False, default=0, type=float)
+    parser.add_argument('-n', '--clients', help="Number of simulated Savant hosts", required=False, default=5,
+                        type=int)
+    parser.add_argument('--commands', help="Light commands each Savant host sends per second (0 for none)",
+                        required=False, default=0, type=float)
+    parser.add_argument('-t', '--time', help="Seconds to measure for", required=False, default=20, type=float)
+    parser.add_argument('--drain', help="Seconds to wait for the last changes to arrive", required=False,
+                        default=3, type=float)
+    parser.add_argument('-l', '--log', help="CoProcessor logging level", required=False, default="WARNING")
+    parser.add_argument('--json', help="Print the report as JSON, to compare runs", required=False,
+                        action='store_true')
+    parser.add_argument('--wholehouse', help="After measuring, send one command to every light from a single host "
+                                             "and count the requests the bridge receives", required=False,
+                        action='store_true')
+    argv = sys.argv[1:]
+    passed_args = []
+    if '--' in argv:
+        passed_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    results = benchmark(args, passed_args)
+    if args.json:
+        print(json.dumps(results, indent=1))
+    else:
+        print_report(results)
+    if args.wholehouse and ('-b' in passed_args or '--batch' in passed_args):
+        house = results['whole_house']
+        if house['group_puts'] != 1 or house['light_puts'] or house['answered'] != house['lights']:
+            raise SystemExit('The whole-house command was not sent as a single group action')
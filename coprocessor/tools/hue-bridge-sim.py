@@ -0,0 +1,424 @@
+#!/usr/bin/python3
+#     'http-Savant Bridge' - Hue bridge stand-in
+#     Copyright (C) '2018'  J14 Systems Ltd
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+# A local stand-in for a Philips Hue bridge so the CoProcessor can be run without one. It serves the
+# v1 REST API the CoProcessor polls and commands, and the CLIP v2 server-sent event stream.
+#
+#   ./hue-bridge-sim.py -P 8080 -L 20 -G 4 -S 2 -c 2
+#   ../hue-coprocessor.py -d -a 127.0.0.1:8080 -k simulator -e --eventurl http://127.0.0.1:8080/eventstream/clip/v2
+
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from queue import Queue, Empty
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+gamut_a = [[0.704, 0.296], [0.2151, 0.7106], [0.138, 0.08]]
+gamut_c = [[0.6915, 0.3083], [0.17, 0.7], [0.1532, 0.0475]]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RateLimit:
+    # Commands over the limit are refused, as a busy bridge does, rather than queued
+    def __init__(self, rate):
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.tokens = float(rate)
+        self.stamp = time.time()
+        self.refused = 0
+
+    def allow(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                self.refused += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+class SimulatedBridge:
+    def __init__(self, lights, groups, sensors):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.resource_ids = {}
+        self.lights = {}
+        self.groups = {}
+        self.sensors = {}
+        self.scenes = {}
+        self.rules = {}
+        # State commands received over the API, by resource
+        self.puts = {'lights': 0, 'groups': 0}
+        for number in range(1, lights + 1):
+            self.lights[str(number)] = self.make_light(number)
+        light_ids = sorted(self.lights, key=int)
+        for number in range(1, groups + 1):
+            members = light_ids[number - 1::groups]
+            self.groups[str(number)] = self.make_group(number, members)
+            scene_id = uuid.uuid4().hex[:15]
+            self.scenes[scene_id] = self.make_scene(number, members)
+        for number in range(1, sensors + 1):
+            self.sensors[str(number)] = self.make_sensor(number)
+            # The Hue app sets up a handful of rules behind every motion sensor
+            for rule in range(8):
+                self.rules[str(len(self.rules) + 1)] = self.make_rule(number, rule)
+
+    @staticmethod
+    def make_light(number):
+        # Every fourth light is a gamut A LightStrip, the rest are gamut C bulbs
+        strip = number % 4 == 0
+        return {
+            "state": {"on": True, "bri": 254, "hue": 8418, "sat": 140, "effect": "none",
+                      "xy": [0.4573, 0.41], "ct": 366, "alert": "none", "colormode": "xy",
+                      "mode": "homeautomation", "reachable": True},
+            "swupdate": {"state": "noupdates", "lastinstall": "2018-01-02T19:24:20"},
+            "type": "Extended color light",
+            "name": "Hue %s %s" % ("lightstrip" if strip else "color lamp", number),
+            "modelid": "LST001" if strip else "LCT015",
+            "manufacturername": "Signify Netherlands B.V.",
+            "productname": "Hue lightstrip" if strip else "Hue color lamp",
+            "capabilities": {"certified": True,
+                             "control": {"mindimlevel": 1000, "maxlumen": 806,
+                                         "colorgamuttype": "A" if strip else "C",
+                                         "colorgamut": gamut_a if strip else gamut_c,
+                                         "ct": {"min": 153, "max": 500}},
+                             "streaming": {"renderer": True, "proxy": True}},
+            "config": {"archetype": "sultanbulb", "function": "mixed", "direction": "omnidirectional"},
+            "uniqueid": "00:17:88:01:00:00:%02x:%02x-0b" % (number // 256, number % 256),
+            "swversion": "1.50.2_r30933"
+        }
+
+    @staticmethod
+    def make_group(number, members):
+        return {
+            "name": "Room %s" % number,
+            "lights": members,
+            "sensors": [],
+            "type": "Room",
+            "state": {"all_on": True, "any_on": True},
+            "recycle": False,
+            "class": "Living room",
+            "action": {"on": True, "bri": 254, "hue": 8418, "sat": 140, "effect": "none",
+                       "xy": [0.4573, 0.41], "ct": 366, "alert": "none", "colormode": "xy"}
+        }
+
+    @staticmethod
+    def make_scene(number, members):
+        return {
+            "name": "Relax %s" % number,
+            "type": "GroupScene",
+            "group": str(number),
+            "lights": members,
+            "owner": "simulator",
+            "recycle": False,
+            "locked": False,
+            "appdata": {"version": 1, "data": "relax_r%02d_d01" % number},
+            "picture": "",
+            "lastupdated": "2018-01-02T19:24:20",
+            "version": 2
+        }
+
+    @staticmethod
+    def make_sensor(number):
+        return {
+            "state": {"presence": False, "lastupdated": "2018-01-02T19:24:20"},
+            "swupdate": {"state": "noupdates", "lastinstall": "2018-01-02T19:24:20"},
+            "config": {"on": True, "battery": 100, "reachable": True, "alert": "none", "sensitivity": 2,
+                       "sensitivitymax": 2, "ledindication": False, "usertest": False, "pending": []},
+            "name": "Hue motion sensor %s" % number,
+            "type": "ZLLPresence",
+            "modelid": "SML001",
+            "manufacturername": "Signify Netherlands B.V.",
+            "productname": "Hue motion sensor",
+            "swversion": "6.1.1.27575",
+            "uniqueid": "00:17:88:01:02:00:%02x:%02x-02-0406" % (number // 256, number % 256)
+        }
+
+    @staticmethod
+    def make_rule(sensor, number):
+        return {
+            "name": "MotionSensor %s.rule%s" % (sensor, number),
+            "owner": "simulator",
+            "created": "2018-01-02T19:24:20",
+            "lasttriggered": "none",
+            "timestriggered": 0,
+            "status": "enabled",
+            "recycle": True,
+            "conditions": [
+                {"address": "/sensors/%s/state/presence" % sensor, "operator": "eq", "value": "true"},
+                {"address": "/sensors/%s/state/presence" % sensor, "operator": "dx"},
+                {"address": "/config/localtime", "operator": "in", "value": "T%02d:00:00/T%02d:00:00"
+                                                                             % (number * 3, number * 3 + 3)}
+            ],
+            "actions": [
+                {"address": "/groups/%s/action" % sensor, "method": "PUT", "body": {"scene": "sim%s" % number}},
+                {"address": "/sensors/%s/state" % sensor, "method": "PUT", "body": {"status": 1}}
+            ]
+        }
+
+    def document(self):
+        with self.lock:
+            return json.dumps({
+                "lights": self.lights, "groups": self.groups, "sensors": self.sensors, "scenes": self.scenes,
+                "config": {"name": "Simulated bridge", "modelid": "BSB002", "apiversion": "1.50.0",
+                           "whitelist": dict(("%032x" % number, {"last use date": "2018-01-02T19:24:20",
+                                                                 "create date": "2018-01-02T19:24:20",
+                                                                 "name": "app#%s" % number})
+                                             for number in range(20))},
+                "rules": self.rules, "schedules": {}, "resourcelinks": {}
+            })
+
+    def section(self, parts):
+        with self.lock:
+            node = {"lights": self.lights, "groups": self.groups, "sensors": self.sensors,
+                    "scenes": self.scenes}
+            for part in parts:
+                node = node[part]
+            return json.dumps(node)
+
+    def set_state(self, device, device_id, body):
+        results = [{"success": {"/%s/%s/%s/%s" % (device, device_id, 'state' if device == 'lights' else 'action',
+                                                  key): body[key]}} for key in body]
+        with self.lock:
+            if device == 'lights':
+                targets = [device_id]
+            else:
+                if device_id == '0':
+                    targets = list(self.lights)
+                else:
+                    targets = list(self.groups[device_id]['lights'])
+                if 'scene' in body:
+                    targets = list(self.scenes[body['scene']]['lights'])
+                    body = {'on': True, 'bri': random.randint(1, 254)}
+            if 'bri' in body and 'on' not in body:
+                body['on'] = True
+            for light_id in targets:
+                self.lights[light_id]['state'].update(self.state_fields(body))
+            if device == 'groups' and device_id in self.groups:
+                self.groups[device_id]['action'].update(self.state_fields(body))
+        # A real bridge follows light changes with updates for every group holding them, group 0 included
+        with self.lock:
+            group_ids = ['0'] + [group_id for group_id, group in self.groups.items()
+                                 if set(group['lights']) & set(targets)]
+        self.publish([self.light_event(light_id) for light_id in targets] +
+                     [self.grouped_light_event(group_id) for group_id in group_ids])
+        return results
+
+    @staticmethod
+    def state_fields(body):
+        fields = dict((key, body[key]) for key in body if key != 'transitiontime')
+        if 'xy' in fields:
+            fields['colormode'] = 'xy'
+        elif 'ct' in fields:
+            fields['colormode'] = 'ct'
+        return fields
+
+    def resource_id(self, id_v1):
+        if id_v1 not in self.resource_ids:
+            self.resource_ids[id_v1] = str(uuid.uuid4())
+        return self.resource_ids[id_v1]
+
+    def light_event(self, light_id):
+        with self.lock:
+            state = self.lights[light_id]['state']
+            return {
+                "id": self.resource_id('/lights/%s' % light_id),
+                "id_v1": "/lights/%s" % light_id,
+                "type": "light",
+                "on": {"on": state['on']},
+                "dimming": {"brightness": round(state['bri'] * 100 / 254.0, 2)},
+                "color": {"xy": {"x": state['xy'][0], "y": state['xy'][1]}}
+            }
+
+    def grouped_light_event(self, group_id):
+        with self.lock:
+            members = list(self.lights) if group_id == '0' else self.groups[group_id]['lights']
+            lit = [self.lights[light_id]['state']['bri'] for light_id in members
+                   if self.lights[light_id]['state']['on']]
+            return {
+                "id": self.resource_id('/groups/%s' % group_id),
+                "id_v1": "/groups/%s" % group_id,
+                "type": "grouped_light",
+                "on": {"on": bool(lit)},
+                "dimming": {"brightness": round(sum(lit) / len(lit) * 100 / 254.0, 2) if lit else 0}
+            }
+
+    def sensor_event(self, sensor_id):
+        with self.lock:
+            return {
+                "id": self.resource_id('/sensors/%s' % sensor_id),
+                "id_v1": "/sensors/%s" % sensor_id,
+                "type": "motion",
+                "motion": {"motion": self.sensors[sensor_id]['state']['presence']}
+            }
+
+    def publish(self, resources):
+        event = [{"creationtime": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                  "id": str(uuid.uuid4()), "type": "update", "data": resources}]
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def random_change(self):
+        if self.sensors and random.random() < 0.2:
+            sensor_id = random.choice(list(self.sensors))
+            with self.lock:
+                state = self.sensors[sensor_id]['state']
+                state['presence'] = not state['presence']
+                state['lastupdated'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+            self.publish([self.sensor_event(sensor_id)])
+        elif self.lights:
+            light_id = random.choice(list(self.lights))
+            change = random.choice(({'bri': random.randint(1, 254)},
+                                    {'on': random.random() < 0.7},
+                                    {'xy': [round(random.uniform(0.15, 0.6), 4),
+                                            round(random.uniform(0.05, 0.6), 4)]}))
+            self.set_state('lights', light_id, change)
+
+
+class BridgeRequestHandler(BaseHTTPRequestHandler):
+    bridge = None
+    stream_lifetime = 0
+    # Seconds added to every API reply, and the RateLimit commands are held to
+    latency = 0
+    limit = None
+
+    def log_message(self, log_format, *args):
+        pass
+
+    def reply(self, status, payload):
+        if self.latency:
+            time.sleep(self.latency)
+        data = payload.encode() if isinstance(payload, str) else payload
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def error(self, address, description):
+        self.reply(200, json.dumps([{"error": {"type": 3, "address": address, "description": description}}]))
+
+    def do_GET(self):
+        if self.path.startswith('/eventstream/'):
+            return self.event_stream()
+        parts = self.path.strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'api':
+            return self.error(self.path, 'method, GET, not available for resource, %s' % self.path)
+        if len(parts) == 2:
+            return self.reply(200, self.bridge.document())
+        try:
+            self.reply(200, self.bridge.section(parts[2:]))
+        except KeyError:
+            self.error(self.path, 'resource, %s, not available' % self.path)
+
+    def do_PUT(self):
+        parts = self.path.strip('/').split('/')
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            device, device_id = parts[2], parts[3]
+            if device not in ('lights', 'groups'):
+                raise KeyError(device)
+            if self.limit is not None and not self.limit.allow():
+                return self.reply(429, json.dumps([{"error": {"type": 901, "address": self.path,
+                                                              "description": "Internal error, 429"}}]))
+            with self.bridge.lock:
+                self.bridge.puts[device] += 1
+            self.reply(200, json.dumps(self.bridge.set_state(device, device_id, body)))
+        except (KeyError, IndexError, ValueError):
+            self.error(self.path, 'resource, %s, not available' % self.path)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(200, json.dumps([{"success": {"username": "simulator"}}]))
+
+    def event_stream(self):
+        subscriber = Queue()
+        with self.bridge.lock:
+            self.bridge.subscribers.append(subscriber)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(b': hi\n\n')
+            self.wfile.flush()
+            started = time.time()
+            while not self.stream_lifetime or time.time() - started < self.stream_lifetime:
+                try:
+                    event = subscriber.get(timeout=1)
+                except Empty:
+                    continue
+                self.wfile.write(('id: %s:0\ndata: %s\n\n' % (int(time.time()), json.dumps(event))).encode())
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            with self.bridge.lock:
+                self.bridge.subscribers.remove(subscriber)
+
+
+def change_generator(bridge, rate):
+    while True:
+        time.sleep(1.0 / rate)
+        bridge.random_change()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated Philips Hue bridge")
+    parser.add_argument('-P', '--port', help="Port to serve the HTTP API on",
+                        required=False, default=8080, type=int)
+    parser.add_argument('-L', '--lights', help="Number of lights", required=False, default=20, type=int)
+    parser.add_argument('-G', '--groups', help="Number of rooms (and scenes)", required=False, default=4, type=int)
+    parser.add_argument('-S', '--sensors', help="Number of motion sensors", required=False, default=2, type=int)
+    parser.add_argument('-c', '--changes', help="Random device changes per second (0 to disable)",
+                        required=False, default=0.0, type=float)
+    parser.add_argument('--streamlifetime', help="Close event streams after this many seconds, "
+                                                 "to exercise the polling fall back (0 to disable)",
+                        required=False, default=0, type=float)
+    parser.add_argument('--latency', help="Milliseconds added to every API reply", required=False, default=0,
+                        type=float)
+    parser.add_argument('--ratelimit', help="Light and group commands accepted per second, the rest are refused "
+                                            "(0 to disable)",
+                        required=False, default=0, type=float)
+    args = parser.parse_args()
+
+    BridgeRequestHandler.bridge = SimulatedBridge(args.lights, args.groups, args.sensors)
+    BridgeRequestHandler.stream_lifetime = args.streamlifetime
+    BridgeRequestHandler.latency = args.latency / 1000.0
+    if args.ratelimit > 0:
+        BridgeRequestHandler.limit = RateLimit(args.ratelimit)
+    if args.changes > 0:
+        generator = threading.Thread(target=change_generator, args=(BridgeRequestHandler.bridge, args.changes))
+        generator.setDaemon(True)
+        generator.start()
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), BridgeRequestHandler)
+    print('Simulated Hue bridge listening on port %s' % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()